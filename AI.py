@@ -1,134 +1,142 @@
 # coding: utf-8
-import gym
-import gym.spaces
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
 import numpy as np
 import gomoku
-from keras.models import Sequential
-from keras.layers import Dense, Activation, Flatten
-from keras.optimizers import Adam
-from rl.agents.dqn import DQNAgent
-from rl.policy import EpsGreedyQPolicy
-from rl.memory import SequentialMemory
+from instrument import PROFILER, now
+from metrics import Sampler, get_logger
 from datetime import datetime
 
 SCALE = 9
 
+logger = get_logger("AI")
+
+# DQN.pyに移したKeras・keras-rlに依存する名前(AI.GomokuMemoryのように参照したときに読み込む)
+_DQN_NAMES = ["GomokuEpsPolicy", "GomokuMemory", "SharedMemory", "CheckpointCallback",
+              "load_checkpoint", "restore_checkpoint"]
+
+
+def __getattr__(name):
+    if name in _DQN_NAMES:
+        import DQN
+        return getattr(DQN, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 
 def create_dqn(env, param_file=None):
     """
     DQNエージェントを生成する関数
+    Keras・keras-rlはここで初めて読み込む(対戦や表形式のQ学習だけなら読み込まない)
     """
-    nb_actions = env.action_space.n
-    # DQNのネットワーク定義
-    model = Sequential()
-    model.add(Flatten(input_shape=(1,) + env.observation_space.shape))
-    model.add(Dense(16))
-    model.add(Activation('relu'))
-    model.add(Dense(16))
-    model.add(Activation('relu'))
-    model.add(Dense(16))
-    model.add(Activation('relu'))
-    model.add(Dense(nb_actions))
-    model.add(Activation('linear'))
-    print(model.summary())
-    memory = SequentialMemory(limit=50000, window_length=1)
-    # 行動方策はオーソドックスなepsilon-greedy。ほかに、各行動のQ値によって確率を決定するBoltzmannQPolicyが利用可能
-    policy = GomokuEpsPolicy(env._board, eps=0.1)
-    dqn = DQNAgent(model=model, nb_actions=nb_actions, memory=memory,
-                   target_model_update=1e-2, policy=policy)
-    dqn.compile(Adam(lr=1e-3), metrics=['mae'])
-
-    if param_file:
-        model.load_weights(param_file)
-
-    return dqn
-
-
-class GomokuEpsPolicy(EpsGreedyQPolicy):
-    """
-    epsilon-greedy + 置けない場所はフィルタリング
-    すなわち，1-epsの確率で置ける場所のうち，q値が最大の場所を選ぶ
-    """
-    def __init__ (self, board, eps=.1):
-        super(GomokuEpsPolicy, self).__init__(eps)
-        self._board = board
-
-    def select_action(self, q_values):
-        """
-        Q値に基づいて，行動を選択する関数
-        :param q_values:
-        :return:行動
-        """
-        if np.random.uniform() < self.eps:
-            # epsの確率で，ランダムに選択する
-            state = self._board.get_state()
-            tmp = np.array(range(state.shape[0]))
-            tmp = tmp[state == 0]
-            if tmp.shape[0] == 0:
-                # 引き分け時でも呼ばれる可能性があるので，そのときは，-1をかえす
-                action = -1
-            else:
-                action = np.random.choice(tmp)
-        else:
-            assert self._board.get_state().shape[0] == q_values.shape[0]
-            tmp = np.zeros(q_values.shape[0]) + float("-inf")
-            tmp[self._board.get_state()== 0] = q_values[self._board.get_state()== 0]
-            action = np.argmax(tmp)
-
-        return action
+    import DQN
+    return DQN.create_dqn(env, param_file)
 
 
-class GomokuEnv(gym.core.Env):
+class GomokuEnv(object):
     """
     五目並べの環境クラス
+    gymのEnvと同じインターフェース(reset, step, action_space, observation_space)を持つが，
+    gymは空間を初めて参照したときに読み込む
     """
     def __init__(self, board):
         self._board = board
-
-        # 実行可能なアクションの空間らしい
-        self.action_space = gym.spaces.Discrete(self._board._scale**2)
-
-        # 碁盤を観測可能な状態とする
-        # 観測対象の状態空間らしい
-        high = np.zeros(self._board._scale**2)+2
-        low = np.zeros(self._board._scale**2)
-        self.observation_space = gym.spaces.Box(low=low, high=high)
+        # 行動数(セル数)
+        self.nb_actions = self._board._scale**2
+        self._action_space = None
+        self._observation_space = None
         # 対戦相手
         self._other = None
         # 一番最初は，自分が先手で相手が後手
         # 実験ごとに，ランダムで入れ替える．
         self._color = 2
+        # 終局ごとに手順を書き込む記録器
+        self._recorder = None
+
+    @property
+    def action_space(self):
+        """
+        実行可能なアクションの空間
+        """
+        if self._action_space is None:
+            import gym.spaces
+            self._action_space = gym.spaces.Discrete(self.nb_actions)
+        return self._action_space
+
+    @property
+    def observation_space(self):
+        """
+        観測対象の状態空間(碁盤を観測可能な状態とする)
+        """
+        if self._observation_space is None:
+            import gym.spaces
+            high = np.zeros(self.nb_actions)+2
+            low = np.zeros(self.nb_actions)
+            self._observation_space = gym.spaces.Box(low=low, high=high)
+        return self._observation_space
 
     def set_other(self, other):
         self._other = other
         self._other.set_color(1)
 
+    def set_recorder(self, recorder):
+        """
+        終局ごとに手順を書き込む記録器を設定する関数
+        :param recorder: records.GameRecordWriter(Noneなら記録しない)
+        """
+        self._recorder = recorder
+
+    def _record(self, result):
+        if self._recorder is not None:
+            self._recorder.write_board(self._board, result, (type(self._other).__name__, "agent"))
+
     def _step(self, action):
         """
         行動によって，状態を変更する関数
         """
 
         if action == -1:
-            print ("unexpected output")
-            self._board.output_status()
+            logger.error("unexpected output\n%s\n%s", self._board.get_state(), self._board._history)
             assert False
 
+        profile = PROFILER.enabled
+        if profile:
+            t = now()
+            PROFILER.count("env_steps")
         x, y = self._board.index_to_point(action)
         assert self._board.can_put_stone(x, y)
 
         self._board.put(x, y, self._color)
+        if profile:
+            t = PROFILER.lap("put", t)
         ret = self._board.judge_game()
+        if profile:
+            t = PROFILER.lap("judge", t)
         if ret == self._color:
+            self._record(ret)
             return self._board.get_state(), 1.0, True, {}
         elif ret == 3:
+            self._record(ret)
             return self._board.get_state(), 0.0, True, {}
         else:
             x, y,color = self._other.action()
+            if profile:
+                t = PROFILER.lap("opponent_action", t)
             self._board.put(x, y, color)
+            if profile:
+                t = PROFILER.lap("put", t)
             ret = self._board.judge_game()
+            if profile:
+                PROFILER.lap("judge", t)
             if ret == self._other.get_color():
+                self._record(ret)
                 return self._board.get_state(), -1.0, True, {}
             elif ret == 3:
+                self._record(ret)
                 return self._board.get_state(), 0.0, True, {}
         return self._board.get_state(),0.0, False, {}
 
@@ -136,19 +144,268 @@ class GomokuEnv(gym.core.Env):
         """
         初期状態を返す関数(?)
         """
+        if PROFILER.enabled:
+            t = now()
         self._board.reset()
         self._other.reset()
+        if PROFILER.enabled:
+            t = PROFILER.lap("reset", t)
 
         x, y, color = self._other.action()
+        if PROFILER.enabled:
+            t = PROFILER.lap("opponent_action", t)
         self._board.put(x, y , color)
+        if PROFILER.enabled:
+            PROFILER.lap("put", t)
 
         return self._board.get_state()
 
+    def reset(self):
+        return self._reset()
+
+    def step(self, action):
+        return self._step(action)
+
+    def render(self, mode="human", close=False):
+        if not close:
+            self._board.show_board()
+
+    def close(self):
+        pass
+
+    def seed(self, seed=None):
+        return []
+
+
+class VecGomokuEnv(object):
+    """
+    複数の五目並べを同時に進める環境クラス
+    K局分の碁盤をBatchBoardで持ち，行動・対戦相手の手・終了判定をまとめて行う
+    決着した対局はその場で初期化し，相手の初手まで進めておく
+    """
+    def __init__(self, n_envs, scale, other):
+        """
+        :param n_envs: 同時に進める対局数
+        :param scale: 碁盤のサイズ
+        :param other: 対戦相手(batch_actionを実装したPlayer．RandomPlayer, FoolAI, HeuristicPlayerが使える)
+        """
+        if not hasattr(other, "batch_action"):
+            raise TypeError("%s cannot play on a BatchBoard (no batch_action); "
+                            "use RandomPlayer, FoolAI or HeuristicPlayer" % type(other).__name__)
+        self._n_envs = n_envs
+        self._board = gomoku.BatchBoard(n_envs, scale)
+        self.nb_actions = scale ** 2
+        self._other = other
+        self._other.set_color(1)
+        self._color = 2
+
+    def get_board(self):
+        return self._board
+
+    def get_legal_mask(self):
+        """
+        各対局で置ける場所のマスクを返す関数
+        """
+        return self._board.get_legal_mask()
+
+    def _other_action(self, rows):
+        """
+        対戦相手の手を指定した対局でまとめて打つ関数
+        :return 対局ごとの判定結果
+        """
+        index = self._other.batch_action(self._board, rows)
+        return self._board.put_and_judge(index, self._other.get_color(), rows)
+
+    def _reset(self, rows=None):
+        """
+        指定した対局を初期化し，相手の初手を打つ関数
+        :return 全対局の観測
+        """
+        if rows is None:
+            rows = np.arange(self._n_envs)
+        self._board.reset(rows)
+        self._other_action(rows)
+        return self._board.get_state().copy()
+
+    def _step(self, actions):
+        """
+        全対局で行動をまとめて実行する関数
+        :param actions: 対局ごとの行動(セルのインデックス)
+        :return 観測，報酬，終了フラグ，情報のリストのタプル
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        assert np.all(actions >= 0)
+        rewards = np.zeros(self._n_envs)
+        dones = np.zeros(self._n_envs, dtype=bool)
+
+        ret = self._board.put_and_judge(actions, self._color)
+        dones[ret != 0] = True
+        rewards[ret == self._color] = 1.0
+
+        rows = np.where(~dones)[0]
+        if rows.shape[0] > 0:
+            ret = self._other_action(rows)
+            dones[rows[ret != 0]] = True
+            rewards[rows[ret == self._other.get_color()]] = -1.0
+
+        infos = [{} for _ in range(self._n_envs)]
+        finished = np.where(dones)[0]
+        if finished.shape[0] > 0:
+            # 終了時の盤面は情報として返し，観測は次の対局の初期状態にする
+            for i in finished:
+                infos[i]["terminal_observation"] = self._board.get_state()[i].copy()
+            self._reset(finished)
+        return self._board.get_state().copy(), rewards, dones, infos
+
+    def reset(self):
+        return self._reset()
+
+    def step(self, actions):
+        return self._step(actions)
 
-def learning(lcount, scount, in_file=None, out_file=None):
+    def select_actions(self, q_values, eps=.1):
+        """
+        全対局のQ値からepsilon-greedyで行動をまとめて選ぶ関数
+        置けない場所はフィルタリングする
+        :param q_values: (対局数, 行動数)のQ値
+        """
+        legal = self.get_legal_mask()
+        masked = np.where(legal, q_values, float("-inf"))
+        actions = np.argmax(masked, axis=1)
+        explore = np.random.uniform(size=self._n_envs) < eps
+        if explore.any():
+            actions[explore] = self._board.random_valid_index(np.where(explore)[0])
+        return actions
+
+
+class SharedReplayBuffer(object):
+    """
+    プロセス間で共有するリングバッファ
+    複数のアクタープロセスが遷移(s, a, r, s', 終了)を書き込み，学習プロセスがサンプリングする
+    """
+    def __init__(self, limit, nb_cells, ctx=None):
+        """
+        :param limit: 保持する遷移の最大数
+        :param nb_cells: 盤面のセル数
+        :param ctx: 共有メモリを作るmultiprocessingのコンテキスト(アクターの起動方法に合わせる)
+        """
+        if ctx is None:
+            ctx = multiprocessing
+        self._limit = limit
+        self._nb_cells = nb_cells
+        self._obs0 = ctx.RawArray('b', limit * nb_cells)
+        self._obs1 = ctx.RawArray('b', limit * nb_cells)
+        self._actions = ctx.RawArray('q', limit)
+        self._rewards = ctx.RawArray('f', limit)
+        self._terminals = ctx.RawArray('b', limit)
+        self._index = ctx.RawValue('q', 0)
+        self._count = ctx.RawValue('q', 0)
+        self._lock = ctx.Lock()
+        self._make_views()
+
+    def _make_views(self):
+        self._obs0_view = np.frombuffer(self._obs0, dtype=np.int8).reshape(self._limit, self._nb_cells)
+        self._obs1_view = np.frombuffer(self._obs1, dtype=np.int8).reshape(self._limit, self._nb_cells)
+        self._actions_view = np.frombuffer(self._actions, dtype=np.int64)
+        self._rewards_view = np.frombuffer(self._rewards, dtype=np.float32)
+        self._terminals_view = np.frombuffer(self._terminals, dtype=np.int8)
+
+    def __getstate__(self):
+        # numpyのビューは子プロセスで作り直す
+        state = self.__dict__.copy()
+        for name in ["_obs0_view", "_obs1_view", "_actions_view", "_rewards_view", "_terminals_view"]:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    @property
+    def nb_entries(self):
+        return self._count.value
+
+    def append(self, obs0, action, reward, obs1, terminal):
+        """
+        遷移を1つ書き込む関数
+        """
+        with self._lock:
+            i = self._index.value
+            self._obs0_view[i] = obs0
+            self._obs1_view[i] = obs1
+            self._actions_view[i] = action
+            self._rewards_view[i] = reward
+            self._terminals_view[i] = terminal
+            self._index.value = (i + 1) % self._limit
+            self._count.value = min(self._count.value + 1, self._limit)
+
+    def sample(self, batch_size):
+        """
+        遷移をランダムに取り出す関数
+        :return (s, a, r, s', 終了)の配列のタプル
+        """
+        with self._lock:
+            idx = np.random.randint(0, self._count.value, size=batch_size)
+            return (self._obs0_view[idx].astype(np.float64), self._actions_view[idx].copy(),
+                    self._rewards_view[idx].astype(np.float64), self._obs1_view[idx].astype(np.float64),
+                    self._terminals_view[idx].astype(bool))
+
+
+class SharedWeights(object):
+    """
+    学習プロセスのネットワークの重みをアクタープロセスに配るための共有メモリ
+    """
+    def __init__(self, weights, ctx=None):
+        """
+        :param weights: model.get_weights()の形式の重み(形状を決めるために使う)
+        :param ctx: 共有メモリを作るmultiprocessingのコンテキスト
+        """
+        if ctx is None:
+            ctx = multiprocessing
+        self._shapes = [w.shape for w in weights]
+        self._sizes = [int(np.prod(s)) for s in self._shapes]
+        self._data = ctx.RawArray('f', sum(self._sizes))
+        self._version = ctx.RawValue('q', 0)
+        self._lock = ctx.Lock()
+
+    def publish(self, weights):
+        """
+        重みを書き込んで版を進める関数
+        """
+        flat = np.concatenate([np.asarray(w, dtype=np.float32).ravel() for w in weights])
+        with self._lock:
+            np.frombuffer(self._data, dtype=np.float32)[:] = flat
+            self._version.value = self._version.value + 1
+
+    def get_version(self):
+        return self._version.value
+
+    def pull(self):
+        """
+        最新の重みを読み出す関数
+        :return (版, 重みのリスト)のタプル
+        """
+        with self._lock:
+            flat = np.frombuffer(self._data, dtype=np.float32).copy()
+            version = self._version.value
+        weights = []
+        offset = 0
+        for shape, size in zip(self._shapes, self._sizes):
+            weights.append(flat[offset:offset + size].reshape(shape))
+            offset = offset + size
+        return version, weights
+
+
+def learning(lcount, scount, in_file=None, out_file=None,
+             checkpoint_dir=None, checkpoint_interval=100000, save_memory=False, resume=None):
     """
     五目並べの学習をする関数
+    :param checkpoint_dir: 定期的にチェックポイントを保存するディレクトリ(Noneなら保存しない)
+    :param checkpoint_interval: チェックポイントを保存する間隔(ステップ数)
+    :param save_memory: チェックポイントにリプレイメモリも含めるかどうか
+    :param resume: 最新のチェックポイントから再開するディレクトリ(checkpoint_dirの既定値にもなる)
     """
+    import DQN
     board = gomoku.Board(SCALE)
     env = GomokuEnv(board)
 
@@ -157,53 +414,567 @@ def learning(lcount, scount, in_file=None, out_file=None):
         # other = gomoku.FoolAI()
         other = gomoku.RandomPlayer()
     else:
-        other = gomoku.AIPlayer(create_dqn(env, in_file))
+        other = gomoku.AIPlayer(QValueCache(create_dqn(env, in_file), board))
 
     other.set_board(board)
     env.set_other(other)
     dqn = create_dqn(env, None)
+
+    step_offset = 0
+    if resume is not None:
+        if checkpoint_dir is None:
+            checkpoint_dir = resume
+        checkpoint = DQN.load_checkpoint(resume)
+        if checkpoint is not None:
+            memory_restored = DQN.restore_checkpoint(dqn, checkpoint)
+            step_offset = checkpoint[0]["step"]
+            # ウォームアップはやり直さない(メモリを戻していない場合は1バッチ分だけ溜める)
+            dqn.nb_steps_warmup = 0 if memory_restored else dqn.batch_size
+            logger.info("resume from step %d", step_offset)
+
+    callbacks = []
+    if checkpoint_dir is not None:
+        checkpoint_callback = DQN.CheckpointCallback(dqn, checkpoint_dir, checkpoint_interval,
+                                                 save_memory=save_memory, step_offset=step_offset)
+        callbacks.append(checkpoint_callback)
     # AIの学習
-    history = dqn.fit(env, nb_steps=lcount, verbose=2)
-    print(history)
+    try:
+        history = dqn.fit(env, nb_steps=max(lcount - step_offset, 0), verbose=2, callbacks=callbacks)
+    finally:
+        if checkpoint_dir is not None:
+            checkpoint_callback.close()
+    logger.info("%s", history.history)
     if out_file:
         dqn.model.save_weights(out_file,True)
     # 学習結果に基づいて勝負
     return dqn, simulate(scount, dqn, other, True)
 
 
-def simulate(count, dqn, other, change):
+def learning_parallel(lcount, scount, n_actors=None, in_file=None, out_file=None,
+                      memory_limit=500000, sync_interval=100, seed=0):
+    """
+    複数のアクタープロセスで対戦しながら学習する関数
+    アクターは共有メモリの重みを定期的に取り込みながら対戦し，遷移をSharedReplayBufferに書き込む．
+    学習プロセスはそこからサンプリングしてネットワークを更新し続ける
+    :param lcount: 学習(ネットワークの更新)の回数
+    :param n_actors: アクターのプロセス数(Noneなら CPU数-1，最低1)
+    :param sync_interval: 学習側が重みを配る間隔(更新回数)
+    """
+    import DQN
+    if n_actors is None:
+        n_actors = max(os.cpu_count() - 1, 1)
+    board = gomoku.Board(SCALE)
+    env = GomokuEnv(board)
+    if in_file is None:
+        other = gomoku.RandomPlayer()
+    else:
+        other = gomoku.AIPlayer(QValueCache(create_dqn(env, in_file), board))
+    other.set_board(board)
+    env.set_other(other)
+
+    # Keras(TensorFlow)はforkと相性が悪いので，アクターはspawnで起動する
+    ctx = multiprocessing.get_context("spawn")
+    dqn = create_dqn(env, None)
+    buffer = SharedReplayBuffer(memory_limit, SCALE ** 2, ctx)
+    weights = SharedWeights(dqn.model.get_weights(), ctx)
+    weights.publish(dqn.model.get_weights())
+    dqn.memory = DQN.SharedMemory(buffer)
+
+    stop = ctx.Event()
+    actors = [ctx.Process(target=_actor_loop,
+                          args=(i, buffer, weights, stop, in_file, dqn.policy.eps, seed))
+              for i in range(n_actors)]
+    for actor in actors:
+        actor.start()
+    try:
+        # ウォームアップ分の遷移が溜まるまで待つ
+        while buffer.nb_entries < max(dqn.nb_steps_warmup, dqn.batch_size):
+            _check_actors(actors)
+            stop.wait(0.1)
+        dqn.reset_states()
+        dqn.training = True
+        for step in range(lcount):
+            # backwardはstepがウォームアップを超えているときだけ学習するので，その後の番号を渡す
+            dqn.step = dqn.nb_steps_warmup + step + 1
+            dqn.backward(0., terminal=False)
+            if step % sync_interval == 0:
+                _check_actors(actors)
+                weights.publish(dqn.model.get_weights())
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.join()
+
+    if out_file:
+        dqn.model.save_weights(out_file, True)
+    return dqn, simulate(scount, dqn, other, True)
+
+
+def _check_actors(actors):
+    """
+    アクターはstopが立つまで終わらないので，終わっているものがあれば例外にする
+    (子プロセスでの読み込みやKerasのエラーで全滅したまま学習側が待ち続けないように)
+    """
+    dead = [(i, a.exitcode) for i, a in enumerate(actors) if not a.is_alive()]
+    if dead:
+        raise RuntimeError("actor process died: " + ", ".join("#%d (exitcode %s)" % d for d in dead))
+
+
+def _actor_loop(actor_id, buffer, weights, stop, in_file, eps, seed):
+    """
+    アクタープロセスの本体
+    自分の碁盤・対戦相手・ネットワークを持ち，重みを取り込みながら対戦して遷移を書き込む
+    """
+    import DQN
+    np.random.seed(np.random.SeedSequence([seed, actor_id]).generate_state(1)[0])
+    board = gomoku.Board(SCALE)
+    env = GomokuEnv(board)
+    if in_file is None:
+        other = gomoku.RandomPlayer()
+    else:
+        other = gomoku.AIPlayer(QValueCache(create_dqn(env, in_file), board))
+    other.set_board(board)
+    env.set_other(other)
+    dqn = create_dqn(env, None)
+    policy = DQN.GomokuEpsPolicy(board, eps=eps)
+    version = -1
+
+    # 碁盤の配列は石を置くと書き換わるので，観測はコピーして持つ
+    obs = env._reset().copy()
+    while not stop.is_set():
+        if weights.get_version() != version:
+            version, w = weights.pull()
+            dqn.model.set_weights(w)
+        q_values = dqn.model.predict_on_batch(obs.reshape((1, 1) + obs.shape))[0]
+        action = policy.select_action(q_values)
+        next_obs, reward, done, _ = env._step(action)
+        buffer.append(obs, action, reward, next_obs, done)
+        if done:
+            obs = env._reset().copy()
+        else:
+            obs = next_obs.copy()
+
+
+def simulate(count, dqn, other, change, sink=None, board_every=100, cache_size=0):
     """
     指定された回数だけ五目並べを繰り返す関数
     (先手での勝利数，後手での勝利数，AIで対応できなかった回数のリストを返す)
+    :param sink: 1試合ごとの記録を書き出すmetrics.EpisodeSink(Noneなら書き出さない)
+    :param board_every: 何試合に1回，終局の盤面をDEBUGログに出力するか
+    :param cache_size: AIのQ値を覚えておく盤面の数(QValueCache)．0ならキャッシュしない
+                       学習後のdqnはtrainingがTrueのまま(置けない場所を除いたepsilon-greedyで選ぶ)なので，
+                       キャッシュできるのはtraining=Falseにしたdqnだけ
     """
     first_win = 0
     second_win = 0
     miss_count_list = []
-    ai = gomoku.AIPlayer(dqn)
+    if cache_size > 0:
+        ai = gomoku.AIPlayer(QValueCache(dqn, other.get_board(), cache_size))
+    else:
+        ai = gomoku.AIPlayer(dqn)
     ai.set_board(other.get_board())
     game = gomoku.Game(ai, other)
     game.reset()
+    board_sampler = Sampler(board_every)
     for i in range(count):
-        print ("start simulation " + str(i))
+        logger.debug("start simulation %d", i)
         result = game.play(False)
         miss_count_list.append(ai.get_miss_count())
         if result == 1 and ai.get_color() == 1:
             first_win = first_win + 1
-            print("AI is win")
+            outcome = "win"
         elif result == 2 and ai.get_color() == 2:
             second_win = second_win + 1
-            print("AI is win")
+            outcome = "win"
         elif result == 3:
-            print ("draw")
+            outcome = "draw"
         else:
-            print("AI is lose")
-        other._board.show_board()
+            outcome = "lose"
+        logger.debug("AI is %s", outcome)
+        if board_sampler.hit() and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("\n%s", other.get_board().to_string())
+        if sink is not None:
+            sink.write({"game": i, "result": int(result), "ai_color": ai.get_color(), "outcome": outcome,
+                        "turns": other.get_board().get_turn_count(), "miss": ai.get_miss_count()})
         game.reset()
         if change:
             game.change()
 
     return first_win, second_win, miss_count_list
 
+
+class QValueCache(object):
+    """
+    DQNのQ値を盤面のハッシュごとに覚えておき，同じ盤面ではネットワークを使わずに返すクラス
+    重みを更新せず，training=FalseのDQN(create_dqnで重みを読み込んだ学習時の対戦相手など)に使う
+    forwardを持つので，AIPlayerのaiとしてそのまま使える
+    返す行動はtraining=FalseのDQNAgent.forward(GreedyQPolicy)と同じく，Q値が最大の場所
+    (training=Trueのときの方策とは異なるので，学習中・学習直後のdqnには使えない)
+    """
+    def __init__(self, dqn, board=None, max_size=100000, symmetry=False):
+        """
+        :param dqn: 重みを固定したDQNエージェント
+        :param board: forwardに渡す盤面の碁盤(そのハッシュをキーにする)．Noneなら盤面からハッシュを計算する
+        :param max_size: 覚えておく盤面の最大数(超えたら最も長く使っていない盤面から捨てる)
+        :param symmetry: 回転・反転した盤面を同じ盤面として扱うかどうか
+                         (boardを渡す場合は，symmetry=Trueで生成した碁盤が必要)
+        """
+        assert not dqn.training, "QValueCache needs a frozen agent (dqn.training must be False)"
+        self._model = dqn.model
+        self._board = board
+        self._max_size = max_size
+        self._symmetry = symmetry
+        self._cache = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        # 碁盤がないときに盤面からハッシュを計算するための表(最初の盤面のサイズで作る)
+        self._zobrist = None
+        self._perms = None
+
+    def _key(self, state):
+        """
+        盤面のキーを求める関数
+        :return (キー, 実際の盤面のセル→正規形の盤面のセルの対応)のタプル(symmetry=Falseのときは対応はNone)
+        """
+        board = self._board
+        if board is not None:
+            if self._symmetry:
+                key, k = board.get_canonical_hash()
+                return key, board.get_symmetry(k)
+            return board.get_hash(), None
+        if self._zobrist is None:
+            scale = int(round(np.sqrt(state.shape[0])))
+            self._zobrist = np.array(gomoku._zobrist_table(scale), dtype=np.uint64)
+            if self._symmetry:
+                self._perms = gomoku._symmetry_permutations(scale)[0]
+            else:
+                self._perms = np.arange(scale ** 2)[None, :]
+        hashes = np.bitwise_xor.reduce(self._zobrist[self._perms, state.astype(np.int64)], axis=1)
+        if not self._symmetry:
+            return int(hashes[0]), None
+        k = int(np.argmin(hashes))
+        return int(hashes[k]), self._perms[k]
+
+    def q_values(self, state):
+        """
+        盤面に対するQ値を返す関数(返した配列は書き換えないこと)
+        """
+        key, perm = self._key(state)
+        q_values = self._cache.get(key)
+        if q_values is not None:
+            self._cache.move_to_end(key)
+            self._hits = self._hits + 1
+        else:
+            self._misses = self._misses + 1
+            q_values = self._model.predict_on_batch(state.reshape((1, 1) + state.shape))[0]
+            if perm is not None:
+                # 正規形の盤面のセルの順で覚えておく
+                canonical = np.empty_like(q_values)
+                canonical[perm] = q_values
+                q_values = canonical
+            self._cache[key] = q_values
+            if len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        if perm is not None:
+            return q_values[perm]
+        return q_values
+
+    def forward(self, state):
+        """
+        盤面に対する行動を返す関数
+        :return 行動(セルのインデックス)
+        """
+        return int(np.argmax(self.q_values(state)))
+
+    def get_stats(self):
+        """
+        (ヒットした回数, ミスした回数)を返す関数
+        """
+        return self._hits, self._misses
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class BatchedPredictor(object):
+    """
+    同時に進む複数の対局からの推論要求をまとめて，1回のpredictで処理するクラス
+    forwardを持つので，AIPlayerのaiとしてそのまま使える
+    返す行動は置ける場所のうちQ値が最大の場所
+    """
+    def __init__(self, model, max_batch_size=64, max_latency=0.002):
+        """
+        :param model: Kerasのモデル(入力は(バッチ, 1, セル数))
+        :param max_batch_size: 1回のpredictでまとめる最大の盤面数
+        :param max_latency: 最初の要求から，バッチが埋まるのを待つ最大の秒数
+        """
+        self._model = model
+        if hasattr(model, "_make_predict_function"):
+            # 別スレッドからpredictするために，先に推論用の関数を作っておく
+            model._make_predict_function()
+        self._max_batch_size = max_batch_size
+        self._max_latency = max_latency
+        self._queue = queue.Queue()
+        self._batch_count = 0
+        self._request_count = 0
+        # closeした後に要求を受け付けないためのロック
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def forward(self, state):
+        """
+        盤面に対する行動を返す関数(結果が出るまで待つ)
+        :param state: 盤面
+        :return 行動(セルのインデックス)
+        """
+        # [盤面, 完了の通知, 行動, 推論で起きた例外]
+        request = [np.array(state), threading.Event(), None, None]
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("BatchedPredictor is closed")
+            self._queue.put(request)
+        request[1].wait()
+        if request[3] is not None:
+            raise request[3]
+        return request[2]
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = time.time() + self._max_latency
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+            try:
+                self._predict(batch)
+            except Exception as e:
+                # 推論に失敗しても待っている呼び出し側が止まらないよう，例外を渡して起こす
+                logger.exception("prediction failed")
+                self._fail(batch, e)
+
+    def _fail(self, batch, error):
+        for request in batch:
+            request[3] = error
+            request[1].set()
+
+    def _predict(self, batch):
+        states = np.stack([r[0] for r in batch])
+        q_values = self._model.predict_on_batch(states.reshape((states.shape[0], 1) + states.shape[1:]))
+        q_values = np.where(states == 0, q_values, float("-inf"))
+        actions = np.argmax(q_values, axis=1)
+        self._batch_count = self._batch_count + 1
+        self._request_count = self._request_count + len(batch)
+        for request, action in zip(batch, actions):
+            request[2] = int(action)
+            request[1].set()
+
+    def get_stats(self):
+        """
+        (predictの回数, 処理した要求数)を返す関数
+        """
+        return self._batch_count, self._request_count
+
+    def close(self):
+        """
+        推論スレッドを止める関数
+        処理されずに残った要求には例外を渡して起こす
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        pending = []
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                pending.append(request)
+        self._fail(pending, RuntimeError("BatchedPredictor is closed"))
+
+
+def simulate_concurrent(count, dqn, other_factory, change, n_games=32, max_batch_size=64, max_latency=0.002):
+    """
+    n_games局を別々のスレッドで同時に進め，AIの推論をBatchedPredictorでまとめて行うsimulate
+    :param other_factory: 対戦相手のプレイヤーを返す関数
+    :return (先手での勝利数，後手での勝利数，AIで対応できなかった回数のリスト)
+    """
+    predictor = BatchedPredictor(dqn.model, max_batch_size, max_latency)
+    results = [None] * n_games
+    errors = []
+    bounds = np.linspace(0, count, n_games + 1).astype(int)
+
+    def run(i):
+        try:
+            play(i)
+        except Exception as e:
+            errors.append(e)
+
+    def play(i):
+        first_win = 0
+        second_win = 0
+        miss_count_list = []
+        board = gomoku.Board(SCALE)
+        ai = gomoku.AIPlayer(predictor)
+        other = other_factory()
+        for j in range(bounds[i], bounds[i + 1]):
+            if change and j % 2 == 1:
+                game = gomoku.Game(other, ai, board)
+            else:
+                game = gomoku.Game(ai, other, board)
+            game.reset()
+            result = game.play(False)
+            miss_count_list.append(ai.get_miss_count())
+            if result == 1 and ai.get_color() == 1:
+                first_win = first_win + 1
+            elif result == 2 and ai.get_color() == 2:
+                second_win = second_win + 1
+        results[i] = (first_win, second_win, miss_count_list)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n_games)]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        predictor.close()
+    if errors:
+        # 推論の失敗などで止まった対局があれば，呼び出し側に伝える
+        raise errors[0]
+
+    miss_count_list = []
+    for r in results:
+        miss_count_list.extend(r[2])
+    return sum(r[0] for r in results), sum(r[1] for r in results), miss_count_list
+
+
+def _dqn_q_values(dqn, state, color):
+    """
+    手番の色から見た盤面に対するQ値を返す関数
+    DQNは後手(色2)として学習しているので，手番が先手のときは石の色を入れ替えて入力する
+    """
+    if color == 1:
+        state = np.where(state == 0, 0, 3 - state)
+    return dqn.model.predict_on_batch(state.reshape((1, 1) + state.shape))[0]
+
+
+def dqn_prior(dqn):
+    """
+    DQNのQ値のsoftmaxを，MCTSPlayerの事前確率(prior)として返す関数を作る
+    """
+    def prior(state, color):
+        q_values = _dqn_q_values(dqn, state, color)
+        e = np.exp(q_values - q_values.max())
+        return e / e.sum()
+    return prior
+
+
+def dqn_value(dqn):
+    """
+    置ける場所のQ値の最大値を，MCTSPlayerの評価値(value)として返す関数を作る
+    """
+    def value(state, color):
+        q_values = _dqn_q_values(dqn, state, color)
+        return float(np.clip(q_values[state == 0].max(), -1.0, 1.0))
+    return value
+
+
+def dqn_player(param_file, scale=SCALE):
+    """
+    学習済みの重みからAIPlayerを生成する関数
+    simulate_parallelのワーカー内で呼べるよう，functools.partialで包んで渡す
+    :param param_file: 重みのファイル
+    :param scale: 重みを学習した碁盤のサイズ
+    """
+    board = gomoku.Board(scale)
+    env = GomokuEnv(board)
+    return gomoku.AIPlayer(QValueCache(create_dqn(env, param_file)))
+
+
+def simulate_parallel(count, ai_factory, other_factory, change, processes=None, seed=0):
+    """
+    simulateをプロセスプールで並列に行う関数
+    各ワーカーは自分の碁盤とプレイヤーを生成し，試合ごとに(seed, 試合番号)から決まる乱数で対戦する．
+    そのため結果はワーカー数によらず同じになる
+    :param ai_factory: AIのプレイヤー(get_miss_countを持つ)を返す，pickle可能な関数(ワーカーはspawnで起動するので，モジュールの関数やそのfunctools.partialにする)
+    :param other_factory: 対戦相手のプレイヤーを返す，pickle可能な関数
+    :param processes: ワーカー数(Noneなら CPU数)
+    :param seed: 乱数のシード
+    :return (先手での勝利数，後手での勝利数，AIで対応できなかった回数のリスト)
+    """
+    if processes is None:
+        processes = os.cpu_count()
+    bounds = np.linspace(0, count, processes + 1).astype(int)
+    tasks = [(bounds[i], bounds[i + 1], ai_factory, other_factory, change, seed)
+             for i in range(processes) if bounds[i] < bounds[i + 1]]
+    # 親プロセスがKeras(TensorFlow)を読み込んでいてもよいよう，learning_parallelと同じくspawnで起動する
+    pool = multiprocessing.get_context("spawn").Pool(processes)
+    try:
+        parts = pool.starmap(_simulate_range, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    first_win = sum(p[0] for p in parts)
+    second_win = sum(p[1] for p in parts)
+    miss_count_list = []
+    for p in parts:
+        miss_count_list.extend(p[2])
+    return first_win, second_win, miss_count_list
+
+
+def _simulate_range(start, stop, ai_factory, other_factory, change, seed, scale=SCALE):
+    """
+    試合番号start〜stop-1の試合を行うワーカー関数
+    AIのプレイヤーがget_miss_countを持たない場合，失敗回数は0とする
+    :return (先手での勝利数，後手での勝利数，AIで対応できなかった回数のリスト，引き分け数)
+    """
+    first_win = 0
+    second_win = 0
+    draws = 0
+    miss_count_list = []
+    board = gomoku.Board(scale)
+    ai = ai_factory()
+    other = other_factory()
+    for i in range(start, stop):
+        np.random.seed(np.random.SeedSequence([seed, i]).generate_state(1)[0])
+        # simulateと同じく，changeなら1試合ごとに先手/後手を入れ替える
+        if change and i % 2 == 1:
+            game = gomoku.Game(other, ai, board)
+        else:
+            game = gomoku.Game(ai, other, board)
+        game.reset()
+        result = game.play(False)
+        miss_count_list.append(ai.get_miss_count() if hasattr(ai, "get_miss_count") else 0)
+        if result == 1 and ai.get_color() == 1:
+            first_win = first_win + 1
+        elif result == 2 and ai.get_color() == 2:
+            second_win = second_win + 1
+        elif result == 3:
+            draws = draws + 1
+
+    return first_win, second_win, miss_count_list, draws
+
+
 if __name__ == "__main__":
     l_count = 10000000
     s_count = 1000
@@ -0,0 +1,382 @@
+# coding: utf-8
+# Keras・keras-rlに依存する部分(DQNのネットワーク，方策，リプレイメモリ，チェックポイント)
+# AI.pyからは必要になったときに読み込むので，対戦だけのプロセスはこれらを読み込まない
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime
+import numpy as np
+from metrics import get_logger
+from keras.models import Sequential
+from keras.layers import Dense, Activation, Flatten
+from keras.optimizers import Adam
+from rl.agents.dqn import DQNAgent
+from rl.policy import EpsGreedyQPolicy
+from rl.memory import Memory, Experience
+from rl.callbacks import Callback
+
+logger = get_logger("DQN")
+
+
+def create_dqn(env, param_file=None):
+    """
+    DQNエージェントを生成する関数
+    """
+    nb_actions = env.nb_actions
+    # DQNのネットワーク定義
+    model = Sequential()
+    model.add(Flatten(input_shape=(1,) + env.observation_space.shape))
+    model.add(Dense(16))
+    model.add(Activation('relu'))
+    model.add(Dense(16))
+    model.add(Activation('relu'))
+    model.add(Dense(16))
+    model.add(Activation('relu'))
+    model.add(Dense(nb_actions))
+    model.add(Activation('linear'))
+    if logger.isEnabledFor(logging.DEBUG):
+        lines = []
+        model.summary(print_fn=lines.append)
+        logger.debug("\n%s", "\n".join(lines))
+    memory = GomokuMemory(limit=50000, nb_cells=nb_actions, window_length=1)
+    # 行動方策はオーソドックスなepsilon-greedy。ほかに、各行動のQ値によって確率を決定するBoltzmannQPolicyが利用可能
+    policy = GomokuEpsPolicy(env._board, eps=0.1)
+    dqn = DQNAgent(model=model, nb_actions=nb_actions, memory=memory,
+                   target_model_update=1e-2, policy=policy)
+    dqn.compile(Adam(lr=1e-3), metrics=['mae'])
+
+    if param_file:
+        model.load_weights(param_file)
+
+    return dqn
+
+
+class GomokuEpsPolicy(EpsGreedyQPolicy):
+    """
+    epsilon-greedy + 置けない場所はフィルタリング
+    すなわち，1-epsの確率で置ける場所のうち，q値が最大の場所を選ぶ
+    """
+    def __init__ (self, board, eps=.1):
+        super(GomokuEpsPolicy, self).__init__(eps)
+        self._board = board
+
+    def select_action(self, q_values):
+        """
+        Q値に基づいて，行動を選択する関数
+        :param q_values:
+        :return:行動
+        """
+        if np.random.uniform() < self.eps:
+            # epsの確率で，ランダムに選択する
+            # 引き分け時でも呼ばれる可能性があるので，そのときは，-1をかえす
+            action = self._board.random_valid_index()
+        else:
+            assert self._board.get_state().shape[0] == q_values.shape[0]
+            action = self._board.masked_argmax(q_values)
+
+        return action
+
+
+class GomokuMemory(Memory):
+    """
+    五目並べ専用のリプレイメモリ
+    盤面は1セル2bit(1バイトに4セル)に詰めて，事前に確保したリングバッファに保持し，
+    サンプリングしたミニバッチだけを展開する
+    サンプリングの仕方はSequentialMemory(window_length=1)と同じ
+    """
+    def __init__(self, limit, nb_cells, **kwargs):
+        """
+        :param limit: 保持する遷移の最大数
+        :param nb_cells: 盤面のセル数
+        """
+        super(GomokuMemory, self).__init__(**kwargs)
+        assert self.window_length == 1
+        self.limit = limit
+        self._nb_cells = nb_cells
+        self._nb_bytes = (nb_cells + 3) // 4
+        self._observations = np.zeros((limit, self._nb_bytes), dtype=np.uint8)
+        self._actions = np.zeros(limit, dtype=np.int32)
+        self._rewards = np.zeros(limit, dtype=np.float32)
+        self._terminals = np.zeros(limit, dtype=bool)
+        self._index = 0
+        self._count = 0
+        self._shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+    def _pack(self, observation):
+        cells = np.zeros(self._nb_bytes * 4, dtype=np.uint8)
+        cells[:self._nb_cells] = observation
+        return np.bitwise_or.reduce(cells.reshape(-1, 4) << self._shifts, axis=1)
+
+    def _unpack(self, packed):
+        cells = (packed[:, :, None] >> self._shifts) & 3
+        return cells.reshape(packed.shape[0], -1)[:, :self._nb_cells].astype(np.float32)
+
+    def append(self, observation, action, reward, terminal, training=True):
+        super(GomokuMemory, self).append(observation, action, reward, terminal, training=training)
+        if training:
+            # 詰めるときにコピーされるので，碁盤の配列を参照していても問題ない
+            self._observations[self._index] = self._pack(observation)
+            self._actions[self._index] = action
+            self._rewards[self._index] = reward
+            self._terminals[self._index] = terminal
+            self._index = (self._index + 1) % self.limit
+            self._count = min(self._count + 1, self.limit)
+
+    def _physical(self, idx):
+        """
+        古い順の番号をリングバッファ上の位置に変換する関数
+        """
+        return (self._index - self._count + idx) % self.limit
+
+    def sample(self, batch_size, batch_idxs=None):
+        assert self._count >= 3
+        if batch_idxs is None:
+            batch_idxs = np.random.randint(2, self._count, size=batch_size)
+        else:
+            batch_idxs = np.array(batch_idxs) + 1
+        # 直前の遷移でエピソードが終わっている場合は，エピソードをまたぐので引き直す
+        invalid = self._terminals[self._physical(batch_idxs - 2)]
+        while invalid.any():
+            batch_idxs[invalid] = np.random.randint(2, self._count, size=int(invalid.sum()))
+            invalid = self._terminals[self._physical(batch_idxs - 2)]
+
+        prev = self._physical(batch_idxs - 1)
+        state0 = self._unpack(self._observations[prev])
+        state1 = self._unpack(self._observations[self._physical(batch_idxs)])
+        return [Experience(state0=[state0[i]], action=self._actions[p], reward=self._rewards[p],
+                           state1=[state1[i]], terminal1=self._terminals[p])
+                for i, p in enumerate(prev)]
+
+    @property
+    def nb_entries(self):
+        return self._count
+
+    def get_config(self):
+        config = super(GomokuMemory, self).get_config()
+        config['limit'] = self.limit
+        return config
+
+    def get_state(self):
+        """
+        チェックポイント用に，保持している遷移を配列のdictで返す関数
+        """
+        return {"observations": self._observations[:self._count].copy(),
+                "actions": self._actions[:self._count].copy(),
+                "rewards": self._rewards[:self._count].copy(),
+                "terminals": self._terminals[:self._count].copy(),
+                "index": np.array(self._index)}
+
+    def set_state(self, state):
+        """
+        get_stateで保存した遷移を戻す関数
+        """
+        count = state["actions"].shape[0]
+        assert count <= self.limit
+        self._observations[:count] = state["observations"]
+        self._actions[:count] = state["actions"]
+        self._rewards[:count] = state["rewards"]
+        self._terminals[:count] = state["terminals"]
+        self._count = count
+        self._index = int(state["index"]) % self.limit
+
+
+class SharedMemory(Memory):
+    """
+    SharedReplayBufferからサンプリングするkeras-rl用のメモリ
+    遷移はアクターが書き込むので，appendでは何もしない
+    """
+    def __init__(self, buffer):
+        super(SharedMemory, self).__init__(window_length=1)
+        self._buffer = buffer
+
+    def append(self, observation, action, reward, terminal, training=True):
+        pass
+
+    def sample(self, batch_size, batch_idxs=None):
+        obs0, actions, rewards, obs1, terminals = self._buffer.sample(batch_size)
+        return [Experience(state0=[obs0[i]], action=actions[i], reward=rewards[i],
+                           state1=[obs1[i]], terminal1=terminals[i]) for i in range(batch_size)]
+
+    @property
+    def nb_entries(self):
+        return self._buffer.nb_entries
+
+    def get_config(self):
+        config = super(SharedMemory, self).get_config()
+        config['limit'] = self._buffer._limit
+        return config
+
+
+class CheckpointCallback(Callback):
+    """
+    学習中に定期的にチェックポイントを保存するkeras-rlのコールバック
+    重みなどのコピーは学習のスレッドで取り，ファイルへの書き出しは別スレッドで行う
+    保存するもの: ネットワークとターゲットネットワークの重み，optimizerの状態，
+    通算のステップ数，epsilon，(指定した場合は)リプレイメモリ
+    """
+    def __init__(self, dqn, directory, interval=100000, keep=3, save_memory=False, step_offset=0):
+        """
+        :param dqn: 学習中のエージェント
+        :param directory: 保存先のディレクトリ
+        :param interval: 保存する間隔(ステップ数)
+        :param keep: 残しておくチェックポイントの数
+        :param save_memory: リプレイメモリも保存するかどうか
+        :param step_offset: 再開したときの，それまでのステップ数
+        """
+        super(CheckpointCallback, self).__init__()
+        self._dqn = dqn
+        self._directory = directory
+        self._interval = interval
+        self._keep = keep
+        self._save_memory = save_memory
+        self._step_offset = step_offset
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # 書き出しが追いつかないときは，次の保存で待つ
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_step_end(self, step, logs={}):
+        # keras-rlはon_step_endを呼んだ後にdqn.stepを進めるので，終わったステップ数は+1
+        global_step = self._step_offset + int(self._dqn.step) + 1
+        if global_step > 0 and global_step % self._interval == 0:
+            self.save(global_step)
+
+    def save(self, global_step):
+        """
+        現在の状態をコピーして，書き出しを別スレッドに頼む関数
+        """
+        arrays = {}
+        for name, weights in [("model", self._dqn.model.get_weights()),
+                              ("target", self._dqn.target_model.get_weights()),
+                              ("optimizer", _optimizer_weights(self._dqn))]:
+            for i, w in enumerate(weights):
+                arrays["%s_%d" % (name, i)] = np.array(w)
+        if self._save_memory and isinstance(self._dqn.memory, GomokuMemory):
+            for name, value in self._dqn.memory.get_state().items():
+                arrays["memory_" + name] = np.array(value)
+        meta = {"step": global_step, "eps": self._dqn.policy.eps, "date": datetime.now().isoformat()}
+        if not self._put((global_step, arrays, meta)):
+            logger.error("checkpoint writer is not running; skipped step %d", global_step)
+
+    def _put(self, item):
+        """
+        書き出しスレッドにitemを渡す関数
+        スレッドが止まっていたら待たずにFalseを返す
+        """
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=1.0)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            global_step = item[0]
+            try:
+                self._write(*item)
+            except Exception:
+                # ディスクが一杯などで失敗しても学習は止めず，次のチェックポイントで再び試す
+                logger.exception("failed to write checkpoint at step %d", global_step)
+
+    def _write(self, global_step, arrays, meta):
+        base = os.path.join(self._directory, "ckpt_%012d" % global_step)
+        # 書きかけのファイルを読まないよう，一時ファイルに書いてから名前を変える
+        # jsonが最後にできるので，jsonがあるチェックポイントだけが完全
+        try:
+            np.savez(base + ".tmp.npz", **arrays)
+            os.replace(base + ".tmp.npz", base + ".npz")
+            with open(base + ".json.tmp", "w") as f:
+                json.dump(meta, f)
+            os.replace(base + ".json.tmp", base + ".json")
+        finally:
+            for tmp in [base + ".tmp.npz", base + ".json.tmp"]:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+        self._remove_old()
+
+    def _remove_old(self):
+        names = sorted(n for n in os.listdir(self._directory) if n.startswith("ckpt_") and n.endswith(".json"))
+        for name in names[:-self._keep]:
+            base = os.path.join(self._directory, name[:-len(".json")])
+            os.remove(base + ".json")
+            os.remove(base + ".npz")
+
+    def close(self):
+        """
+        書き出しが終わるのを待ってスレッドを止める関数
+        """
+        if self._put(None):
+            self._thread.join()
+
+
+def _optimizer(dqn):
+    """
+    状態(Adamのモーメントなど)を持っているoptimizerを返す関数
+    target_model_updateが1未満だとkeras-rlはoptimizerをAdditionalUpdatesOptimizerで包み，
+    包んだ側は状態を持たないので，中のoptimizerを取り出す
+    """
+    optimizer = dqn.trainable_model.optimizer
+    optimizer = getattr(optimizer, "optimizer", optimizer)
+    if len(optimizer.weights) == 0 and hasattr(dqn.trainable_model, "_make_train_function"):
+        # optimizerの変数は学習関数を作るまで存在しないので，先に作っておく
+        dqn.trainable_model._make_train_function()
+    if len(optimizer.weights) == 0:
+        raise RuntimeError("optimizer %s has no state to checkpoint" % type(optimizer).__name__)
+    return optimizer
+
+
+def _optimizer_weights(dqn):
+    return _optimizer(dqn).get_weights()
+
+
+def load_checkpoint(directory):
+    """
+    ディレクトリ内の最新の完全なチェックポイントを読み込む関数
+    :return (メタ情報, 配列のdict)のタプル．チェックポイントがなければNone
+    """
+    if not os.path.exists(directory):
+        return None
+    names = sorted(n for n in os.listdir(directory) if n.startswith("ckpt_") and n.endswith(".json"))
+    if len(names) == 0:
+        return None
+    base = os.path.join(directory, names[-1][:-len(".json")])
+    with open(base + ".json") as f:
+        meta = json.load(f)
+    with np.load(base + ".npz") as data:
+        arrays = dict((name, data[name]) for name in data.files)
+    return meta, arrays
+
+
+def restore_checkpoint(dqn, checkpoint):
+    """
+    チェックポイントの内容をエージェントに戻す関数
+    :return リプレイメモリも戻したかどうか
+    """
+    meta, arrays = checkpoint
+
+    def weights(name):
+        count = len([k for k in arrays if k.startswith(name + "_")])
+        return [arrays["%s_%d" % (name, i)] for i in range(count)]
+
+    dqn.model.set_weights(weights("model"))
+    dqn.target_model.set_weights(weights("target"))
+    optimizer_weights = weights("optimizer")
+    if not optimizer_weights:
+        raise ValueError("checkpoint step %d has no optimizer state" % meta["step"])
+    _optimizer(dqn).set_weights(optimizer_weights)
+    dqn.policy.eps = meta["eps"]
+    memory_state = dict((k[len("memory_"):], v) for k, v in arrays.items() if k.startswith("memory_"))
+    if memory_state and isinstance(dqn.memory, GomokuMemory):
+        dqn.memory.set_state(memory_state)
+        return True
+    return False
@@ -1,51 +1,191 @@
+import logging
 import numpy as np
 import gomoku
 import AI
+import QTable
+from instrument import PROFILER, now
+from metrics import get_logger
 
 ALPHA = 0.1
 GAMMA = 0.99
 SCALE = 9
 
-def learn(n_rounds, env, eps=0.1):
-    Q = {}
-    nb_actions = env.action_space.n
+logger = get_logger("QLearning")
+
+def learn(n_rounds, env, eps=0.1, symmetry=False, Q=None, sink=None):
+    """
+    Q学習を行う関数
+    :param symmetry: 回転・反転で重なる盤面を同じ状態として扱うかどうか
+                     (envの碁盤はsymmetry=Trueで生成しておく)
+    :param Q: Qテーブル(dict，QTable.QTableStoreまたはQTable.QMatrix)．Noneなら新しいdictを使う
+    :param sink: 1エピソードごとの記録を書き出すmetrics.EpisodeSink(Noneなら書き出さない)
+    :return 学習したQテーブル
+    """
+    if Q is None:
+        Q = {}
+    nb_actions = env.nb_actions
+    profile = PROFILER.enabled
+    debug = logger.isEnabledFor(logging.DEBUG)
     for i in range(n_rounds):
         state = env._reset()
-        state_str = state_to_string(state)
-        if not state_str in Q:
+        # 状態は盤面のZobristハッシュで表す
+        state_key, perm = state_to_key(env._board, symmetry)
+        if not state_key in Q:
             # 未到達の状態の場合，Q値をランダムで設定する．
-            Q[state_str] = np.random.random(env.action_space.n)
+            Q[state_key] = np.random.random(nb_actions)
         finish = False
-        print("---start---")
+        steps = 0
+        logger.debug("---start---")
         while not finish :
-            print(state_str)
+            if debug:
+                logger.debug("%016x", state_key)
+            if profile:
+                t = now()
             if np.random.uniform() < eps:
                 # epsの確率で，ランダムに選択する
-                state = env._board.get_state()
-                tmp = np.array(range(state.shape[0]))
-                tmp = tmp[state == 0]
-                if tmp.shape[0] == 0:
-                    # 引き分け時でも呼ばれる可能性があるので，そのときは，-1をかえす
-                    action = -1
-                else:
-                    action = np.random.choice(tmp)
+                # 引き分け時でも呼ばれる可能性があるので，そのときは，-1をかえす
+                action = env._board.random_valid_index()
             else:
-                tmp = np.zeros(Q[state_str].shape[0]) + float("-inf")
-                tmp[env._board.get_state() == 0] = Q[state_str][env._board.get_state() == 0]
-                action = np.argmax(tmp)
+                # 正規形の向きで持っているQ値を実際の盤面の向きに戻す
+                q_values = Q[state_key] if perm is None else Q[state_key][perm]
+                action = env._board.masked_argmax(q_values)
 
+            if profile:
+                t = PROFILER.lap("select_action", t)
+            # env_stepの中のput/judge/opponent_actionは環境側でも計測される
             next_state, reward, finish, tmp = env._step(action)
+            if profile:
+                t = PROFILER.lap("env_step", t)
 
-            next_state_str = state_to_string(next_state)
+            next_state_key, next_perm = state_to_key(env._board, symmetry)
 
-            if not next_state_str in Q:
+            if not next_state_key in Q:
                 # 未到達の状態の場合，Q値をランダムで設定する．
-                Q[next_state_str] = np.random.random(nb_actions)
+                Q[next_state_key] = np.random.random(nb_actions)
 
-            Q[state_str][action]+=ALPHA *(reward + GAMMA*Q[next_state_str].max() - Q[state_str][action])
+            # 最大値は向きによらないので，更新する行動だけ正規形の向きに変換する
+            index = action if perm is None else perm[action]
+            target = reward + GAMMA*Q[next_state_key].max()
+            # QTableStoreでは行がキャッシュから追い出されることがあるので，書き換えた行は代入で書き戻す
+            row = Q[state_key]
+            row[index] += ALPHA * (target - row[index])
+            Q[state_key] = row
+            if profile:
+                PROFILER.lap("learner_update", t)
             state = next_state
-            state_str = state_to_string(state)
-    print("---end---")
+            state_key = next_state_key
+            perm = next_perm
+            steps = steps + 1
+        if sink is not None:
+            sink.write({"episode": i, "steps": steps, "reward": reward, "states": len(Q)})
+    logger.debug("---end---")
+    return Q
+
+def learn_batched(n_rounds, env, eps=0.1, symmetry=False, Q=None, episodes_per_update=1, sink=None):
+    """
+    Q値を1つの行列(QTable.QMatrix)に持ち，エピソード単位でまとめて更新するQ学習の関数
+    episodes_per_update回のエピソードの遷移を集めてから，TD更新を配列演算で一度に行う
+    1エピソードの中では同じ状態は現れないので，episodes_per_update=1ならlearnと同じ更新になる
+    :param Q: QTable.QMatrix．Noneなら新しく作る
+    :param episodes_per_update: 何エピソード分の遷移をまとめて更新するか
+    :return 学習したQテーブル
+    """
+    nb_actions = env.nb_actions
+    if Q is None:
+        Q = QTable.QMatrix(nb_actions)
+    profile = PROFILER.enabled
+    board = env._board
+    # 1ステップごとのPythonの処理を減らすため，遷移は(s, a, r, s')の組で1つのリストに溜める
+    transitions = []
+    append = transitions.append
+    perm = None
+    next_perm = None
+    for i in range(n_rounds):
+        env._reset()
+        if symmetry:
+            state_key, perm = state_to_key(board, True)
+        else:
+            state_key = board.get_hash()
+        row = Q.row(state_key)
+        finish = False
+        steps = 0
+        # epsilon-greedyの乱数はエピソードごとにまとめて引く(盤面のセル数より長いエピソードはない)
+        explore = np.random.random(nb_actions + 1) < eps
+        while not finish:
+            if profile:
+                t = now()
+            if explore[steps]:
+                action = board.random_valid_index()
+            else:
+                # 行列は広がることがあるので，行はその都度取り出す
+                q_values = Q.get_row(row)
+                action = board.masked_argmax(q_values if perm is None else q_values[perm])
+            if profile:
+                t = PROFILER.lap("select_action", t)
+            next_state, reward, finish, tmp = env._step(action)
+            if profile:
+                PROFILER.lap("env_step", t)
+
+            if symmetry:
+                next_state_key, next_perm = state_to_key(board, True)
+            else:
+                next_state_key = board.get_hash()
+            next_row = Q.row(next_state_key)
+            append((row, action if perm is None else perm[action], reward, next_row))
+            row = next_row
+            perm = next_perm
+            steps = steps + 1
+        if sink is not None:
+            sink.write({"episode": i, "steps": steps, "reward": reward, "states": len(Q)})
+
+        if (i + 1) % episodes_per_update == 0 or i == n_rounds - 1:
+            if profile:
+                t = now()
+            batch = np.array(transitions, dtype=np.float64)
+            Q.update(batch[:, 0].astype(np.int64), batch[:, 1].astype(np.int64), batch[:, 2].astype(np.float32),
+                     batch[:, 3].astype(np.int64), ALPHA, GAMMA)
+            if profile:
+                PROFILER.lap("learner_update", t)
+            del transitions[:]
+    return Q
+
+def state_to_key(board, symmetry=False):
+    """
+    盤面からQテーブルのキーを求める関数
+    symmetryがTrueのときは正規形のハッシュをキーとし，
+    実際の盤面の行動→正規形の盤面の行動の対応も返す(Falseのときは None)
+    :return (キー, 行動の対応)のタプル
+    """
+    if symmetry:
+        key, k = board.get_canonical_hash()
+        return key, board.get_symmetry(k)
+    return board.get_hash(), None
+
+class QTablePlayer(gomoku.Player):
+    """
+    学習したQテーブルに従って，置ける場所のうちQ値が最大の場所に置くプレイヤー
+    テーブルにない盤面ではランダムに置く
+    """
+    def __init__(self, Q, symmetry=False):
+        """
+        :param Q: Qテーブル(dictまたは読み込み専用で開いたQTable.QTableStore)
+        :param symmetry: 学習時と同じく正規形のキーを使うかどうか
+        """
+        super(QTablePlayer, self).__init__()
+        self._Q = Q
+        self._symmetry = symmetry
+
+    def action(self):
+        board = self.get_board()
+        key, perm = state_to_key(board, self._symmetry)
+        if key in self._Q:
+            q_values = self._Q[key] if perm is None else self._Q[key][perm]
+            index = board.masked_argmax(q_values)
+        else:
+            index = board.random_valid_index()
+        x, y = board.index_to_point(index)
+        return x, y, self.get_color()
+
 
 def state_to_string(state):
     return ''.join(map(str, state))
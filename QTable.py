@@ -0,0 +1,316 @@
+# coding: utf-8
+import json
+import os
+from collections import OrderedDict
+import numpy as np
+
+# 表の使用率がこれを超えたら容量を倍にする
+MAX_LOAD = 0.7
+# 容量を広げるときに，一度に読み込んで配置し直すスロット数
+GROW_CHUNK = 1 << 16
+
+
+class QTableStore(object):
+    """
+    Q値をディスク上のメモリマップ配列に保持するテーブル
+    キー(盤面のハッシュ)はオープンアドレス法(線形探索)で配置し，
+    よく使う行はLRUのキャッシュとしてメモリ上に持つ
+    dictと同じように Q[key] で行(np.ndarray)を読み書きできる
+    Q[key]が返す行はキャッシュ上の行そのものなので，書き換えた後は Q[key] = row で書き戻すこと
+    (キャッシュから追い出された後の行を書き換えても，ディスクには反映されない)
+    """
+    def __init__(self, path, nb_actions=None, capacity=1 << 16, cache_size=100000, read_only=False):
+        """
+        :param path: テーブルを保存するディレクトリ(既にあれば続きから開く)
+        :param nb_actions: 行動数(新しく作るときだけ必要)
+        :param capacity: 新しく作るときの初期容量(2のべき乗)
+        :param cache_size: メモリ上に持つ行の最大数(2以上．Q[s][a] += ... の途中で次の状態を読んでも
+                           sの行が追い出されないようにするため)
+        :param read_only: 読み込み専用で開くかどうか(学習済みのテーブルで対戦するとき用)
+        """
+        assert cache_size >= 2
+        self._path = path
+        self._cache_size = cache_size
+        self._read_only = read_only
+        self._cache = OrderedDict()
+        if os.path.exists(self._meta_path()):
+            with open(self._meta_path()) as f:
+                meta = json.load(f)
+            self._nb_actions = meta["nb_actions"]
+            self._capacity = meta["capacity"]
+        else:
+            assert not read_only
+            assert nb_actions is not None
+            assert capacity & (capacity - 1) == 0
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self._nb_actions = nb_actions
+            self._capacity = capacity
+            self._count = 0
+            self._create_arrays(path, capacity)
+            self._write_meta()
+        self._open_arrays()
+        # meta.jsonはflushのときにしか書かないので，落ちた後でも正しいよう使用中のスロットを数え直す
+        self._count = int(np.count_nonzero(self._used))
+
+    def _meta_path(self):
+        return os.path.join(self._path, "meta.json")
+
+    def _create_arrays(self, path, capacity):
+        """
+        空の配列ファイルを作る関数
+        """
+        np.memmap(os.path.join(path, "keys.bin"), dtype=np.uint64, mode="w+", shape=(capacity,)).flush()
+        np.memmap(os.path.join(path, "used.bin"), dtype=np.uint8, mode="w+", shape=(capacity,)).flush()
+        np.memmap(os.path.join(path, "values.bin"), dtype=np.float32, mode="w+",
+                  shape=(capacity, self._nb_actions)).flush()
+
+    def _open_arrays(self):
+        mode = "r" if self._read_only else "r+"
+        self._keys, self._used, self._values = self._map_arrays(self._path, self._capacity, mode)
+
+    def _map_arrays(self, path, capacity, mode):
+        """
+        pathの配列ファイルをメモリマップで開く関数
+        :return (キー, 使用中フラグ, Q値)のタプル
+        """
+        keys = np.memmap(os.path.join(path, "keys.bin"), dtype=np.uint64, mode=mode, shape=(capacity,))
+        used = np.memmap(os.path.join(path, "used.bin"), dtype=np.uint8, mode=mode, shape=(capacity,))
+        values = np.memmap(os.path.join(path, "values.bin"), dtype=np.float32, mode=mode,
+                           shape=(capacity, self._nb_actions))
+        return keys, used, values
+
+    def _write_meta(self):
+        meta = {"nb_actions": self._nb_actions, "capacity": self._capacity, "count": self._count}
+        tmp = self._meta_path() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path())
+
+    def _find_slot(self, key):
+        """
+        キーが入っている，または入るべきスロットを探す関数
+        :return (スロット番号, 既にキーがあるかどうか)のタプル
+        """
+        return _probe(self._keys, self._used, self._capacity, key)
+
+    def _cache_row(self, key, row):
+        """
+        行をキャッシュに入れ，溢れた行はディスクに書き戻す関数
+        """
+        self._cache[key] = row
+        if len(self._cache) > self._cache_size:
+            old_key, old_row = self._cache.popitem(last=False)
+            self._write_row(old_key, old_row)
+
+    def _write_row(self, key, row):
+        if self._read_only:
+            return
+        slot, found = self._find_slot(key)
+        assert found
+        self._values[slot] = row
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+        return self._find_slot(key)[1]
+
+    def __getitem__(self, key):
+        row = self._cache.get(key)
+        if row is not None:
+            self._cache.move_to_end(key)
+            return row
+        slot, found = self._find_slot(key)
+        if not found:
+            raise KeyError(key)
+        row = np.array(self._values[slot])
+        self._cache_row(key, row)
+        return row
+
+    def __setitem__(self, key, value):
+        assert not self._read_only
+        row = np.asarray(value, dtype=np.float32)
+        assert row.shape == (self._nb_actions,)
+        if key not in self._cache:
+            slot, found = self._find_slot(key)
+            if not found:
+                if (self._count + 1) > self._capacity * MAX_LOAD:
+                    self._grow()
+                    slot, found = self._find_slot(key)
+                self._keys[slot] = key
+                self._used[slot] = 1
+                self._count = self._count + 1
+        else:
+            self._cache.move_to_end(key)
+        self._cache_row(key, row)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __len__(self):
+        return self._count
+
+    def get_cache_size(self):
+        """
+        メモリ上に持っている行の数を返す関数
+        """
+        return len(self._cache)
+
+    def _grow(self):
+        """
+        容量を倍にして全てのキーを配置し直す関数
+        メモリに収まらない大きさの表でも広げられるよう，新しいファイルを別の場所に作り，
+        古い表をGROW_CHUNKスロットずつ読んで配置し直してから入れ替える
+        """
+        self._flush_cache()
+        capacity = self._capacity * 2
+        tmp_path = self._path + ".grow"
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+        self._create_arrays(tmp_path, capacity)
+        keys, used, values = self._map_arrays(tmp_path, capacity, "r+")
+        for start in range(0, self._capacity, GROW_CHUNK):
+            stop = min(start + GROW_CHUNK, self._capacity)
+            slots = np.where(self._used[start:stop] == 1)[0] + start
+            chunk_keys = np.array(self._keys[slots])
+            chunk_values = np.array(self._values[slots])
+            for key, row in zip(chunk_keys.tolist(), chunk_values):
+                slot, _ = _probe(keys, used, capacity, key)
+                keys[slot] = key
+                used[slot] = 1
+                values[slot] = row
+        keys.flush()
+        used.flush()
+        values.flush()
+        del keys, used, values
+        del self._keys, self._used, self._values
+        for name in ["keys.bin", "used.bin", "values.bin"]:
+            os.replace(os.path.join(tmp_path, name), os.path.join(self._path, name))
+        os.rmdir(tmp_path)
+        self._capacity = capacity
+        self._open_arrays()
+        self._write_meta()
+
+    def _flush_cache(self):
+        for key, row in self._cache.items():
+            self._write_row(key, row)
+
+    def flush(self):
+        """
+        キャッシュの内容をディスクに書き出す関数
+        """
+        if self._read_only:
+            return
+        self._flush_cache()
+        self._keys.flush()
+        self._used.flush()
+        self._values.flush()
+        self._write_meta()
+
+    def close(self):
+        """
+        書き出してからテーブルを閉じる関数
+        """
+        self.flush()
+        self._cache.clear()
+
+
+def _probe(keys, used, capacity, key):
+    """
+    オープンアドレス法(線形探索)でキーのスロットを探す関数
+    :return (スロット番号, 既にキーがあるかどうか)のタプル
+    """
+    mask = capacity - 1
+    slot = key & mask
+    while used[slot]:
+        if int(keys[slot]) == key:
+            return slot, True
+        slot = (slot + 1) & mask
+    return slot, False
+
+
+class QMatrix(object):
+    """
+    Q値を1つの連続したfloat32の行列に持つテーブル
+    キー(盤面のハッシュ)から行番号への対応をdictで持ち，行が足りなくなったら容量を倍に広げる
+    新しい行は広げたときにまとめて乱数で初期化しておく
+    dictと同じように Q[key] で行を読み書きできる(行は行列のビューなので，広げた後は取り直す)
+    """
+    def __init__(self, nb_actions, capacity=1024):
+        """
+        :param nb_actions: 行動数
+        :param capacity: 初期の行数
+        """
+        self._nb_actions = nb_actions
+        self._values = np.random.random((capacity, nb_actions)).astype(np.float32)
+        self._rows = {}
+
+    def row(self, key):
+        """
+        キーに対応する行番号を返す関数(なければ新しい行を割り当てる)
+        """
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._rows)
+            if row >= self._values.shape[0]:
+                self._grow()
+            self._rows[key] = row
+        return row
+
+    def _grow(self):
+        capacity = self._values.shape[0]
+        extra = np.random.random((capacity, self._nb_actions)).astype(np.float32)
+        self._values = np.concatenate([self._values, extra])
+
+    def get_row(self, row):
+        """
+        行番号rowのQ値を返す関数(行列のビュー)
+        """
+        return self._values[row]
+
+    def get_values(self):
+        """
+        使っている部分のQ値の行列を返す関数
+        """
+        return self._values[:len(self._rows)]
+
+    def update(self, rows, actions, rewards, next_rows, alpha, gamma):
+        """
+        TD誤差による更新をまとめて行う関数
+        Q[s,a] += alpha * (r + gamma * max Q[s'] - Q[s,a])
+        目標値は全て更新前のQ値で計算し，同じ(s,a)が複数あればその分だけ足し込む
+        :param rows: 状態sの行番号の配列
+        :param actions: 行動aの配列
+        :param rewards: 報酬rの配列
+        :param next_rows: 次の状態s'の行番号の配列
+        """
+        values = self._values
+        targets = rewards + gamma * values[next_rows].max(axis=1)
+        np.add.at(values, (rows, actions), alpha * (targets - values[rows, actions]))
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __getitem__(self, key):
+        return self._values[self._rows[key]]
+
+    def __setitem__(self, key, value):
+        # rowで行列が広がることがあるので，行番号を先に求めてから書き込む
+        row = self.row(key)
+        self._values[row] = value
+
+    def get(self, key, default=None):
+        if key in self._rows:
+            return self[key]
+        return default
+
+    def __len__(self):
+        return len(self._rows)
+
+    def get_nbytes(self):
+        """
+        行列が確保しているメモリ量(バイト)を返す関数
+        """
+        return self._values.nbytes
@@ -0,0 +1,244 @@
+# coding: utf-8
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+import numpy as np
+import gomoku
+import QTable
+
+SCALES = [9, 15, 19]
+# 各計測を続ける秒数
+DURATION = 2.0
+# 起動時間を計測するモジュール(エンジンだけ，学習環境，表形式のQ学習)
+COLD_START_MODULES = {"engine": "gomoku", "env": "AI", "qlearning": "QLearning"}
+# エンジンだけのワーカーが読み込んではいけないモジュール
+ML_MODULES = ["gym", "keras", "rl", "tensorflow"]
+
+
+def bench_board(scale, duration=DURATION, **board_options):
+    """
+    Board.put + judge_gameの1秒あたりの手数を計測する関数
+    置く順番は事前にシャッフルしておき，盤面の操作だけを計る
+    :param board_options: Boardに渡すオプション(bitboardなど)
+    """
+    board = gomoku.Board(scale, **board_options)
+    orders = [np.random.permutation(scale ** 2) for i in range(100)]
+    moves = 0
+    games = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        board.reset()
+        color = 1
+        result = 0
+        for index in orders[games % len(orders)]:
+            x, y = board.index_to_point(index)
+            board.put(x, y, color)
+            moves = moves + 1
+            result = board.judge_game()
+            if result != 0:
+                break
+            color = 3 - color
+        games = games + 1
+    return moves / (time.perf_counter() - start)
+
+
+def bench_game(scale, duration=DURATION):
+    """
+    RandomPlayer同士のGame.playの1秒あたりの対局数を計測する関数
+    """
+    board = gomoku.Board(scale)
+    game = gomoku.Game(gomoku.RandomPlayer(), gomoku.RandomPlayer(), board)
+    games = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        game.reset()
+        game.play(False)
+        games = games + 1
+    return games / (time.perf_counter() - start)
+
+
+def bench_env(scale, duration=DURATION):
+    """
+    RandomPlayerを相手にしたAI.GomokuEnv._stepの1秒あたりのステップ数を計測する関数
+    行動はランダムに選ぶ
+    """
+    import AI
+    board = gomoku.Board(scale)
+    env = AI.GomokuEnv(board)
+    other = gomoku.RandomPlayer()
+    other.set_board(board)
+    env.set_other(other)
+    steps = 0
+    env._reset()
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        action = np.random.choice(board.get_valid_cells_index())
+        state, reward, done, info = env._step(action)
+        steps = steps + 1
+        if done:
+            env._reset()
+    return steps / (time.perf_counter() - start)
+
+
+def bench_qlearning(scale, n_rounds=200, Q=None, episodes_per_update=None):
+    """
+    Q学習の1秒あたりの更新回数と，Qテーブルのメモリ量(バイト)を計測する関数
+    :param Q: 使うQテーブル(Noneならdict，learn_batchedではQTable.QMatrix)
+    :param episodes_per_update: Noneならlearn，指定したらその間隔でまとめて更新するlearn_batchedを計る
+    """
+    import AI
+    import QLearning
+
+    class CountingEnv(AI.GomokuEnv):
+        def _step(self, action):
+            self.steps = self.steps + 1
+            return super(CountingEnv, self)._step(action)
+
+    board = gomoku.Board(scale)
+    env = CountingEnv(board)
+    env.steps = 0
+    other = gomoku.RandomPlayer()
+    other.set_board(board)
+    env.set_other(other)
+    start = time.perf_counter()
+    if episodes_per_update is None:
+        Q = QLearning.learn(n_rounds, env, Q=Q)
+    else:
+        Q = QLearning.learn_batched(n_rounds, env, Q=Q, episodes_per_update=episodes_per_update)
+    elapsed = time.perf_counter() - start
+    return env.steps / elapsed, table_memory(Q)
+
+
+def bench_cold_start(module, repeat=3):
+    """
+    新しいPythonプロセスでmoduleをimportするのに掛かる時間を計測する関数
+    プロセスプールのワーカー1つを起動するコストの目安になる
+    :return (最短の秒数, プロセスの最大メモリ量(バイト), 読み込まれたML_MODULESのリスト)
+    """
+    code = ("import json, resource, sys, time\n"
+            "t = time.perf_counter()\n"
+            "import %s\n"
+            "elapsed = time.perf_counter() - t\n"
+            # ru_maxrssはLinuxではキロバイト単位
+            "rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024\n"
+            "print(json.dumps([elapsed, rss, [m for m in %r if m in sys.modules]]))\n" % (module, ML_MODULES))
+    results = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(output.decode()))
+    return min(r[0] for r in results), max(r[1] for r in results), results[0][2]
+
+
+def check_win_in_one(player, scale=9, **board_options):
+    """
+    プレイヤーが1手で勝てる局面(両端の空いた四)で勝つ手を選ぶかを調べる関数
+    速さだけでなく，探索が壊れていないかの確認に使う
+    :return 勝つ手を選んだらTrue
+    """
+    board = gomoku.Board(scale, **board_options)
+    y = scale // 2
+    for x in range(2, 6):
+        board.put(x, y, 1)
+    for x, y2 in [(0, 0), (scale - 1, scale - 1), (0, scale - 1), (scale - 1, 0)]:
+        board.put(x, y2, 2)
+    player.set_board(board)
+    player.set_color(1)
+    x, y2, color = player.action()
+    return (x, y2) in [(1, y), (6, y)]
+
+
+def table_memory(Q):
+    """
+    Qテーブルのおおよそのメモリ量(バイト)を返す関数
+    """
+    if hasattr(Q, "get_nbytes"):
+        return Q.get_nbytes()
+    return sys.getsizeof(Q) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in Q.items())
+
+
+def run(scales=SCALES, duration=DURATION):
+    """
+    全ての計測を行い，結果をdictで返す関数
+    """
+    results = {}
+    for scale in scales:
+        r = {}
+        r["board_moves_per_sec"] = bench_board(scale, duration)
+        r["bitboard_moves_per_sec"] = bench_board(scale, duration, bitboard=True)
+        r["games_per_sec"] = bench_game(scale, duration)
+        r["env_steps_per_sec"] = bench_env(scale, duration)
+        updates, memory = bench_qlearning(scale)
+        r["qlearning_updates_per_sec"] = updates
+        r["qlearning_table_bytes"] = memory
+        # 初期容量を小さくして，学習中に行列を広げる場合も含めて計る
+        updates, memory = bench_qlearning(scale, Q=QTable.QMatrix(scale ** 2, capacity=64),
+                                          episodes_per_update=20)
+        r["qmatrix_updates_per_sec"] = updates
+        r["qmatrix_table_bytes"] = memory
+        results[str(scale)] = r
+        print(scale, r)
+    r = {}
+    for name, module in COLD_START_MODULES.items():
+        seconds, rss, loaded = bench_cold_start(module)
+        r[name + "_import_seconds"] = seconds
+        r[name + "_import_rss_bytes"] = rss
+        if loaded:
+            print("warning: import %s loads %s" % (module, ", ".join(loaded)))
+    results["cold_start"] = r
+    print("cold_start", r)
+    return {
+        "date": datetime.now().isoformat(),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+
+
+def compare(old_file, new_file, threshold=0.9):
+    """
+    2つの計測結果を比べて，速度がthreshold倍を下回った項目を返す関数
+    (メモリ量と時間は増えた項目を返す)
+    :return (サイズ, 項目名, 前の値, 今の値)のリスト
+    """
+    with open(old_file) as f:
+        old = json.load(f)["results"]
+    with open(new_file) as f:
+        new = json.load(f)["results"]
+    regressions = []
+    for scale, values in new.items():
+        for name, value in values.items():
+            before = old.get(scale, {}).get(name)
+            if before is None:
+                continue
+            if name.endswith("_bytes") or name.endswith("_seconds"):
+                if value > before / threshold:
+                    regressions.append((scale, name, before, value))
+            elif value < before * threshold:
+                regressions.append((scale, name, before, value))
+    return regressions
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    for name, player in [("mcts", gomoku.MCTSPlayer(playouts=200)),
+                         ("search", gomoku.SearchPlayer(time_limit=0.5, max_depth=2)),
+                         ("heuristic", gomoku.HeuristicPlayer())]:
+        assert check_win_in_one(player, bitboard=True), name + " misses a win in one move"
+    out_file = "benchmark_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".json"
+    if len(sys.argv) > 1:
+        out_file = sys.argv[1]
+    report = run()
+    with open(out_file, "w") as f:
+        json.dump(report, f, indent=2)
+    print("saved: " + out_file)
@@ -1,11 +1,14 @@
 # coding: utf-8
+import time
 import numpy as np
-import AI
+from instrument import PROFILER, now
 
 
 class Player(object):
     """
     五目並べのプレイヤークラス
+    BatchBoardの複数の対局でまとめて打てるプレイヤー(RandomPlayer, FoolAI, HeuristicPlayer)は
+    batch_action(batch_board, rows)で対局ごとの置く場所のインデックスの配列を返す
     """
     def __init__(self):
         self._color = None
@@ -70,6 +73,10 @@ class FoolAI(Player):
         self._index= self._index+1
         return x, y, self.get_color()
 
+    def batch_action(self, batch_board, rows):
+        # 左上から順に置くので，各対局で最初に空いているセルを選ぶ
+        return np.argmax(batch_board.get_legal_mask(rows), axis=1)
+
     def reset(self):
         self._index = 0
 
@@ -113,12 +120,49 @@ class RandomPlayer(Player):
         pass
 
     def action(self):
-        # 置ける場所のIndexを取得
-        tmp = self.get_board().get_valid_cells_index()
-        index = np.random.choice(tmp)
+        # 置ける場所からランダムに選ぶ
+        index = self.get_board().random_valid_index()
         x, y = self.get_board().index_to_point(index)
         return x, y, self.get_color()
 
+    def batch_action(self, batch_board, rows):
+        return batch_board.random_valid_index(rows)
+
+
+class HeuristicPlayer(Player):
+    """
+    五連・四・三を作る(防ぐ)手を優先して置くプレイヤー
+    縦横斜めの全ての5マスの窓の中の石の数をまとめて数え，
+    空きセルごとに攻め(自分の石が増える窓)と守り(相手の石が増える窓)の点数を足し合わせて，最大のセルに置く
+    """
+    def __init__(self, randomize=True):
+        """
+        :param randomize: 同点のセルからランダムに選ぶかどうか(Falseならインデックスの小さいセル)
+        """
+        super(HeuristicPlayer, self).__init__()
+        self._randomize = randomize
+
+    def reset(self):
+        pass
+
+    def action(self):
+        board = self.get_board()
+        scores = _threat_scores(board.get_state(), self.get_color(), _five_windows(board._scale))
+        if self._randomize:
+            # 点数の差は最小でも0.2なので，これより小さい乱数で同点だけをばらつかせる
+            scores = scores + np.random.random(scores.shape[0]) * 0.1
+        x, y = board.index_to_point(int(np.argmax(scores)))
+        return x, y, self.get_color()
+
+    def batch_action(self, batch_board, rows):
+        cells = batch_board.get_state()[rows]
+        scores = _threat_scores(cells, self.get_color(), _five_windows(batch_board._scale))
+        if self._randomize:
+            scores = scores + np.random.random(scores.shape) * 0.1
+        index = np.argmax(scores, axis=1)
+        index[~(cells == 0).any(axis=1)] = -1
+        return index
+
 
 class AIPlayer(Player):
     """
@@ -144,9 +188,8 @@ class AIPlayer(Player):
         if self._board.can_put_stone(x, y):
             return x, y,self.get_color()
         else:
-            # 置ける場所のIndexを取得
-            tmp = self.get_board().get_valid_cells_index()
-            index = np.random.choice(tmp)
+            # 置ける場所からランダムに選ぶ
+            index = self.get_board().random_valid_index()
             x, y = self.get_board().index_to_point(index)
             self._miss_count = self._miss_count + 1
             return x, y, self.get_color()
@@ -155,18 +198,413 @@ class AIPlayer(Player):
         self._miss_count = 0
 
 
+class MCTSPlayer(Player):
+    """
+    モンテカルロ木探索で置く場所を決めるプレイヤー
+    探索の統計は盤面のハッシュをキーにした置換表に持つので，
+    手順が違っても同じ局面なら統計を共有し，次の手番でも前回の探索結果を再利用する
+    碁盤はputとundoで進めたり戻したりするので，終了判定が速いbitboard=Trueの碁盤がおすすめ
+    """
+    def __init__(self, playouts=200, time_limit=None, c_puct=1.5, rollout="random",
+                 prior=None, value=None, max_table_size=1000000):
+        """
+        :param playouts: 1手あたりのプレイアウト回数
+        :param time_limit: 1手あたりの探索時間(秒)．指定した場合はplayoutsより優先する
+        :param c_puct: 探索の強さを決める定数
+        :param rollout: "random"(ランダム)か"local"(直前の手の周りを優先)
+        :param prior: (盤面, 手番の色)から各セルの事前確率を返す関数(Noneなら一様)
+        :param value: (盤面, 手番の色)から手番側の評価値(-1〜1)を返す関数．指定するとロールアウトの代わりに使う
+        :param max_table_size: 置換表の最大の局面数．超えたら置換表を空にする
+        """
+        super(MCTSPlayer, self).__init__()
+        self._playouts = playouts
+        self._time_limit = time_limit
+        self._c_puct = c_puct
+        self._rollout_type = rollout
+        self._prior = prior
+        self._value = value
+        self._max_table_size = max_table_size
+        # 局面のハッシュ -> [訪問回数, 行動ごとの訪問回数, 行動ごとの価値の合計, 事前確率, すぐ勝てる手(なければ-1)]
+        self._table = {}
+
+    def reset(self):
+        self._table = {}
+
+    def get_table_size(self):
+        """
+        置換表に入っている局面の数を返す関数
+        """
+        return len(self._table)
+
+    def action(self):
+        board = self.get_board()
+        if len(self._table) > self._max_table_size:
+            self._table = {}
+        if self._time_limit is None:
+            for i in range(self._playouts):
+                self._search(board)
+        else:
+            end = time.time() + self._time_limit
+            self._search(board)
+            while time.time() < end:
+                self._search(board)
+
+        node = self._table[board.get_hash()]
+        # 訪問回数が同じ手はランダムに選ぶ
+        index = board.masked_argmax(node[1] + np.random.random(node[1].shape[0]) * 0.5)
+        x, y = board.index_to_point(index)
+        return x, y, self.get_color()
+
+    def _expand(self, board, color):
+        """
+        新しい局面を置換表に追加する関数
+        """
+        n = board.get_state().shape[0]
+        legal = board.get_legal_mask()
+        if self._prior is None:
+            prior = legal / float(max(legal.sum(), 1))
+        else:
+            prior = np.where(legal, self._prior(board.get_state(), color), 0.0)
+            prior = prior / max(prior.sum(), 1e-8)
+        return [0, np.zeros(n), np.zeros(n), prior, -1]
+
+    def _select(self, node, board):
+        """
+        PUCTの値が最大の置ける場所を選ぶ関数
+        すぐ勝てる手が分かっていればそれを選び，
+        まだ訪問していない置ける場所があれば，先にそれを(事前確率の高い順に)1回ずつ試す
+        同じ値の場所はランダムに選ぶ
+        """
+        n_total, visits, values, prior, win = node
+        if win >= 0:
+            return win
+        noise = np.random.random(visits.shape[0]) * 1e-9
+        unvisited = board.get_legal_mask() & (visits == 0)
+        if unvisited.any():
+            return int(np.argmax(np.where(unvisited, prior + noise, -1.0)))
+        q_values = values / np.maximum(visits, 1)
+        scores = q_values + self._c_puct * prior * np.sqrt(n_total + 1) / (1 + visits)
+        return board.masked_argmax(scores + noise)
+
+    def _search(self, board):
+        """
+        選択・展開・評価・逆伝播を1回行う関数
+        終わったら碁盤は元の状態に戻る
+        """
+        color = self.get_color()
+        path = []
+        result = 0
+        while True:
+            key = board.get_hash()
+            node = self._table.get(key)
+            if node is None:
+                self._table[key] = self._expand(board, color)
+                break
+            index = self._select(node, board)
+            path.append((node, index, color))
+            x, y = board.index_to_point(index)
+            board.put(x, y, color)
+            result = board.judge_game()
+            if result != 0:
+                if result == color:
+                    node[4] = index
+                break
+            color = 3 - color
+
+        depth = len(path)
+        if result == 0:
+            if self._value is not None:
+                # 評価関数は手番側から見た値なので，勝った色に換算する
+                v = self._value(board.get_state(), color)
+                result = (color, v)
+            else:
+                result = self._rollout(board, color)
+        for i in range(depth):
+            board.undo()
+
+        for node, index, mover in path:
+            node[0] = node[0] + 1
+            node[1][index] = node[1][index] + 1
+            node[2][index] = node[2][index] + self._reward(result, mover)
+
+    def _reward(self, result, mover):
+        """
+        結果をmover側から見た報酬(-1〜1)に変換する関数
+        """
+        if isinstance(result, tuple):
+            color, v = result
+            return v if color == mover else -v
+        if result == mover:
+            return 1.0
+        if result == 3:
+            return 0.0
+        return -1.0
+
+    def _rollout(self, board, color):
+        """
+        決着がつくまで打ち進めて結果を返す関数(打った手は戻す)
+        """
+        moves = 0
+        result = 0
+        while result == 0:
+            index = -1
+            if self._rollout_type == "local":
+                index = self._local_move(board)
+            if index < 0:
+                index = board.random_valid_index()
+            x, y = board.index_to_point(index)
+            board.put(x, y, color)
+            moves = moves + 1
+            result = board.judge_game()
+            color = 3 - color
+        for i in range(moves):
+            board.undo()
+        return result
+
+    def _local_move(self, board):
+        """
+        直前の手の周囲8マスの空きからランダムに選ぶ関数(なければ-1)
+        """
+        last = board.get_last_action()
+        if last is None:
+            return -1
+        last_x, last_y, _ = last
+        candidates = [board.point_to_index(last_x + dx, last_y + dy)
+                      for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                      if board.can_put_stone(last_x + dx, last_y + dy)]
+        if len(candidates) == 0:
+            return -1
+        return candidates[np.random.randint(len(candidates))]
+
+
+class SearchPlayer(Player):
+    """
+    反復深化のalpha-beta探索で置く場所を決めるプレイヤー
+    候補は既にある石の近く(2マス以内)に限り，五連になる窓の数え上げによる脅威
+    (四や三を作る・止める手)の大きい順に並べて探索する
+    末端では四を作る手・止める手だけを読む静止探索を行い，手番の側の1手分の攻めを加えた評価値で打ち切る
+    探索結果は盤面のハッシュをキーにした置換表に保存する．乱数は使わないので結果は決定的
+    """
+    def __init__(self, time_limit=1.0, max_depth=4, max_candidates=10):
+        """
+        :param time_limit: 1手あたりの探索時間(秒)．超えたら最後に探索し終えた深さの結果を使う
+        :param max_depth: 最大の探索の深さ
+        :param max_candidates: 各局面で調べる候補の最大数
+        """
+        super(SearchPlayer, self).__init__()
+        self._time_limit = time_limit
+        self._max_depth = max_depth
+        self._max_candidates = max_candidates
+        # 局面のハッシュ -> (深さ, 評価値, 種類, 最善手)
+        self._table = {}
+        self._deadline = None
+
+    def reset(self):
+        self._table = {}
+
+    def action(self):
+        board = self.get_board()
+        self._deadline = time.time() + self._time_limit
+        best = self._candidates(board, self.get_color())[0]
+        try:
+            for depth in range(1, self._max_depth + 1):
+                score, move = self._negamax(board, depth, -_SEARCH_INF, _SEARCH_INF, self.get_color())
+                best = move
+                if score >= _SEARCH_WIN:
+                    break
+        except _SearchTimeout:
+            pass
+        x, y = board.index_to_point(best)
+        return x, y, self.get_color()
+
+    def _candidates(self, board, color):
+        """
+        調べる候補を脅威の大きい順に返す関数
+        """
+        cells = board.get_state()
+        scale = board._scale
+        if not cells.any():
+            return [board.point_to_index(scale // 2, scale // 2)]
+        # 石のあるセルを2マス分広げて，その中の空きセルを候補にする
+        occupied = np.pad((cells != 0).reshape(scale, scale), 2)
+        near = np.zeros((scale, scale), dtype=bool)
+        for dy in range(5):
+            for dx in range(5):
+                near |= occupied[dy:dy + scale, dx:dx + scale]
+        near = near.ravel() & (cells == 0)
+        scores = _threat_scores(cells, color, _five_windows(scale))
+        index = np.where(near)[0]
+        order = np.argsort(-scores[index], kind="stable")
+        return index[order[:self._max_candidates]].tolist()
+
+    def _negamax(self, board, depth, alpha, beta, color):
+        """
+        手番(color)から見た評価値と最善手を返す関数
+        """
+        if time.time() > self._deadline:
+            raise _SearchTimeout()
+        key = board.get_hash()
+        entry = self._table.get(key)
+        tt_move = None
+        if entry is not None:
+            tt_depth, tt_score, tt_flag, tt_move = entry
+            if tt_depth >= depth:
+                if tt_flag == 0:
+                    return tt_score, tt_move
+                if tt_flag < 0:
+                    beta = min(beta, tt_score)
+                else:
+                    alpha = max(alpha, tt_score)
+                if alpha >= beta:
+                    return tt_score, tt_move
+
+        moves = self._candidates(board, color)
+        if tt_move is not None and tt_move in moves:
+            moves.remove(tt_move)
+            moves.insert(0, tt_move)
+
+        original_alpha = alpha
+        best_score = -_SEARCH_INF
+        best_move = moves[0]
+        for index in moves:
+            x, y = board.index_to_point(index)
+            board.put(x, y, color)
+            result = board.judge_game()
+            if result == color:
+                # 早く勝てる手ほど高く評価する
+                score = _SEARCH_WIN + depth
+            elif result == 3:
+                score = 0
+            elif depth <= 1:
+                # 末端では相手の手番なので，相手から見た静止探索の値を使う
+                score = -self._quiescence(board, _QUIESCENCE_DEPTH, -beta, -alpha, 3 - color)
+            else:
+                score = -self._negamax(board, depth - 1, -beta, -alpha, 3 - color)[0]
+            board.undo()
+            if score > best_score:
+                best_score = score
+                best_move = index
+            alpha = max(alpha, score)
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = -1
+        elif best_score >= beta:
+            flag = 1
+        else:
+            flag = 0
+        self._table[key] = (depth, best_score, flag, best_move)
+        return best_score, best_move
+
+    def _quiescence(self, board, depth, alpha, beta, color):
+        """
+        探索の末端で，四(あと1つで五連になる窓)を作る手と止める手だけを読む関数
+        手番(color)に四があれば勝ち，相手の四が2か所以上あれば負け，1か所なら止める手だけを読む
+        それ以外は手番を考慮した静的評価値で打ち切る(四を作る手でそれを上回れる場合だけ読み進める)
+        :param depth: 読み進める残りの手数
+        :return 手番(color)から見た評価値
+        """
+        if time.time() > self._deadline:
+            raise _SearchTimeout()
+        cells = board.get_state()
+        windows = _five_windows(board._scale)
+        own, other = _window_counts(cells, color, windows)
+        if ((own == 4) & (other == 0)).any():
+            return _SEARCH_WIN
+        fours = windows[(other == 4) & (own == 0)]
+        if fours.shape[0] > 0:
+            blocks = np.unique(fours[cells[fours] == 0])
+            if blocks.shape[0] > 1:
+                return -_SEARCH_WIN
+            moves = blocks.tolist()
+        else:
+            # 手番の側は次に1つ石を置けるので，1手で最も増やせる分を加える
+            gains = (other == 0) * (_WINDOW_WEIGHTS[own + 1] - _WINDOW_WEIGHTS[own])
+            tempo = np.bincount(windows.ravel(), weights=np.repeat(gains, 5), minlength=cells.shape[0])
+            stand_pat = float(((other == 0) * _WINDOW_WEIGHTS[own]).sum() - ((own == 0) * _WINDOW_WEIGHTS[other]).sum()
+                              + tempo[cells == 0].max(initial=0.0))
+            if depth <= 0 or stand_pat >= beta:
+                return stand_pat
+            alpha = max(alpha, stand_pat)
+            threes = windows[(own == 3) & (other == 0)]
+            moves = np.unique(threes[cells[threes] == 0]).tolist()[:self._max_candidates]
+            if not moves:
+                return stand_pat
+        best_score = alpha if fours.shape[0] == 0 else -_SEARCH_INF
+        for index in moves:
+            x, y = board.index_to_point(index)
+            board.put(x, y, color)
+            if board.judge_game() == 3:
+                score = 0
+            elif depth <= 0:
+                # 止める手を読む余裕がないときは，止めた後の盤面を相手から見た評価値で打ち切る
+                score = -_evaluate(board.get_state(), 3 - color, windows)
+            else:
+                score = -self._quiescence(board, depth - 1, -beta, -max(alpha, best_score), 3 - color)
+            board.undo()
+            best_score = max(best_score, score)
+            if best_score >= beta:
+                break
+        return best_score
+
+
+class _SearchTimeout(Exception):
+    pass
+
+
+_SEARCH_WIN = 10 ** 9
+_SEARCH_INF = 10 ** 10
+# 静止探索で読み進める最大の手数
+_QUIESCENCE_DEPTH = 4
+
+
 class Board(object):
 
-    def __init__(self, scale):
+    def __init__(self, scale, bitboard=False, symmetry=False, dtype=np.int64, early_draw=False):
         """
         碁盤オブジェクトのコンストラクタ
         :param scale: 碁盤のサイズ
+        :param bitboard: 終了判定に色ごとのビットボードを使うかどうか
+        :param symmetry: 回転・反転した8通りの盤面のハッシュも保持するかどうか
+        :param dtype: セルの配列の型(省メモリにしたい場合はnp.int8)
+        :param early_draw: どちらも五連を作れなくなった時点で引き分けにするかどうか
         """
         self._scale = scale
         # 学習高速化のため，1次元配列として，碁盤の方法を保持
-        self._cells = np.zeros(self._scale ** 2, dtype=np.int64)
+        self._cells = np.zeros(self._scale ** 2, dtype=dtype)
         self._history = []
+        # 置ける場所のマスクと，空きセルの一覧(_free[:_n_free])．_free_posは各セルの一覧上の位置
+        # 石を置く・取り除くたびに差分で更新するので，合法手を毎回作り直さなくてよい
+        self._all_cells = np.arange(self._scale ** 2)
+        self._legal = np.ones(self._scale ** 2, dtype=bool)
+        self._free = self._all_cells.copy()
+        self._free_pos = self._all_cells.copy()
+        self._n_free = self._scale ** 2
+        # masked_argmaxで使う作業用の配列
+        self._scratch = np.zeros(self._scale ** 2)
         self._BLACK = 2
+        # ビットボードは色ごとに1つの整数で持つ(添字は色)
+        self._bitboard = bitboard
+        self._bits = [0, 0, 0]
+        if bitboard:
+            self._bit_lines = _bit_lines(scale)
+        # 盤面のZobristハッシュ(石を置くたびに差分で更新する)
+        self._zobrist = _zobrist_table(scale)
+        self._hash = 0
+        # 対称な盤面のハッシュ(添字は変換の番号，0は恒等変換)
+        self._symmetry = symmetry
+        self._sym_hashes = [0] * 8
+        if symmetry:
+            self._sym_perms, self._sym_inverses = _symmetry_permutations(scale)
+            self._sym_cells = self._sym_perms.T.tolist()
+        # 5マスの窓ごとの各色の石の数と，色ごとのまだ五連を作れる(相手の石がない)窓の数
+        self._early_draw = early_draw
+        if early_draw:
+            windows = _five_windows(scale)
+            self._cell_windows = [np.where((windows == i).any(axis=1))[0] for i in range(scale ** 2)]
+            self._window_stones = np.zeros((windows.shape[0], 3), dtype=np.int64)
+            self._live = [0, windows.shape[0], windows.shape[0]]
 
     def get_state(self):
         return self._cells
@@ -178,18 +616,86 @@ class Board(object):
     def get_valid_cells_index(self):
         """
         石を置くことができるセルのインデックスを返す
+        内部の空きセルの一覧をそのまま返すので，順番は不定で，書き換えてはいけない
         :return:インデックス
         """
-        return np.where(self._cells == 0)[0]
+        return self._free[:self._n_free]
+
+    def get_legal_mask(self):
+        """
+        石を置くことができるセルをTrueとしたマスクを返す(書き換えてはいけない)
+        """
+        return self._legal
+
+    def random_valid_index(self):
+        """
+        石を置くことができるセルからランダムに1つ選んで返す
+        :return:インデックス(置ける場所がない場合は-1)
+        """
+        if self._n_free == 0:
+            return -1
+        return int(self._free[np.random.randint(self._n_free)])
+
+    def masked_argmax(self, values):
+        """
+        石を置くことができるセルのうち，valuesが最大のセルを返す
+        作業用の配列を使い回すので，新しい配列は作らない
+        :param values: セルごとの値
+        :return:インデックス
+        """
+        scratch = self._scratch
+        scratch.fill(float("-inf"))
+        np.copyto(scratch, values, where=self._legal)
+        return int(np.argmax(scratch))
 
     def set_val(self, x,y, val):
         """
         碁盤の指定座標に値を指定する関数
+        ハッシュなどの付随する状態もここで差分更新するので，undoでも元に戻る
         :param x: x座標
         :param y: y座標
         :param val: 設定する状態
         """
-        self._cells[self.point_to_index(x, y)] = int(val)
+        index = self.point_to_index(x, y)
+        old = int(self._cells[index])
+        if old == 0 and int(val) != 0:
+            # 空きセルの一覧から取り除く(最後の要素と入れ替える)
+            pos = self._free_pos[index]
+            last = self._free[self._n_free - 1]
+            self._free[pos] = last
+            self._free_pos[last] = pos
+            self._n_free = self._n_free - 1
+            self._legal[index] = False
+        elif old != 0 and int(val) == 0:
+            # 空きセルの一覧の末尾に戻す
+            self._free[self._n_free] = index
+            self._free_pos[index] = self._n_free
+            self._n_free = self._n_free + 1
+            self._legal[index] = True
+        self._hash ^= self._zobrist[index][old] ^ self._zobrist[index][int(val)]
+        if self._symmetry:
+            hashes = self._sym_hashes
+            for k, cell in enumerate(self._sym_cells[index]):
+                hashes[k] ^= self._zobrist[cell][old] ^ self._zobrist[cell][int(val)]
+        if self._bitboard:
+            # 番兵列を含めた幅(scale+1)でビット位置を決める
+            bit = 1 << (y * (self._scale + 1) + x)
+            if old != 0:
+                self._bits[old] &= ~bit
+            if int(val) != 0:
+                self._bits[int(val)] |= bit
+        if self._early_draw:
+            windows = self._cell_windows[index]
+            stones = self._window_stones
+            if old != 0:
+                stones[windows, old] -= 1
+                # 取り除いた石が最後の1つだった窓は，相手が再び使える
+                self._live[3 - old] += int(np.count_nonzero(stones[windows, old] == 0))
+            if int(val) != 0:
+                # 初めて石が入る窓は，相手はもう使えない
+                self._live[3 - int(val)] -= int(np.count_nonzero(stones[windows, int(val)] == 0))
+                stones[windows, int(val)] += 1
+        self._cells[index] = int(val)
 
     def get_val(self, x, y):
         """
@@ -234,8 +740,19 @@ class Board(object):
         """
         碁盤の状態を初期化する関数
         """
-        self._cells = np.zeros(self._scale ** 2,dtype=np.int64)
-        self._history = []
+        # 配列は作り直さずに0で埋める
+        self._cells.fill(0)
+        del self._history[:]
+        self._legal.fill(True)
+        np.copyto(self._free, self._all_cells)
+        np.copyto(self._free_pos, self._all_cells)
+        self._n_free = self._scale ** 2
+        self._bits = [0, 0, 0]
+        self._hash = 0
+        self._sym_hashes = [0] * 8
+        if self._early_draw:
+            self._window_stones.fill(0)
+            self._live = [0, self._window_stones.shape[0], self._window_stones.shape[0]]
 
     def get_turn_count(self):
         """
@@ -255,6 +772,15 @@ class Board(object):
         # 終了判定判定に使うので，最後においたところを記録しておく．
         self._history.append((x, y, color))
 
+    def undo(self):
+        """
+        最後に置いた石を取り除いて，1手前の状態に戻す関数
+        :return 取り除いた(x座標, y座標, 石の色)のタプル
+        """
+        x, y, color = self._history.pop()
+        self.set_val(x, y, 0)
+        return x, y, color
+
     def is_out_of_board(self, x, y):
         """
         指定された座標がボードの外かどうかを返す関数
@@ -287,6 +813,9 @@ class Board(object):
         if len(self._history) >= self._scale**2:
             return 3
 
+        if self._bitboard:
+            return self._judge_bitboard(last_x, last_y, last_color)
+
         # 横方向の探索
         line = 1
         # 右方向に同じ色が続いてるかを調べる
@@ -364,16 +893,92 @@ class Board(object):
         if line >= 5:
             return last_color
 
+        return self._judge_dead()
+
+    def _judge_bitboard(self, last_x, last_y, last_color):
+        """
+        ビットボードを使って最後に置いた石を含む列に5連があるか調べる関数
+        :return 勝った場合はその色，そうでなければ0
+        """
+        bits = self._bits[last_color]
+        for mask, shift in self._bit_lines[self.point_to_index(last_x, last_y)]:
+            line = bits & mask
+            # 2連→4連→5連の順にずらしてANDをとる
+            pair = line & (line >> shift)
+            if pair & (pair >> (2 * shift)) & (line >> (4 * shift)):
+                return last_color
+        return self._judge_dead()
+
+    def _judge_dead(self):
+        """
+        early_drawが有効で，どちらの色にも五連を作れる窓が残っていなければ引き分け(3)を返す関数
+        :return 引き分け(3)か継続(0)
+        """
+        if self._early_draw and self._live[1] == 0 and self._live[2] == 0:
+            return 3
         return 0
 
+    def get_live_windows(self, color):
+        """
+        指定した色がまだ五連を作れる(相手の石がない)窓の数を返す関数
+        early_draw=Trueで生成した碁盤でのみ使える
+        """
+        assert self._early_draw
+        return self._live[color]
+
+    def get_hash(self):
+        """
+        現在の盤面の64bitのZobristハッシュを返す関数
+        空の盤面は0になる
+        """
+        return self._hash
+
+    def get_canonical_hash(self):
+        """
+        回転・反転した8通りの盤面のうち，ハッシュが最小のものを正規形として返す関数
+        symmetry=Trueで生成した碁盤でのみ使える
+        :return (正規形のハッシュ, 変換の番号)のタプル
+        """
+        assert self._symmetry
+        hashes = self._sym_hashes
+        key = min(hashes)
+        return key, hashes.index(key)
+
+    def get_symmetry(self, k, inverse=False):
+        """
+        変換kでのセルの対応を返す関数
+        perm = get_symmetry(k)のとき，セルiは変換後の盤面でperm[i]に移る
+        :param k: 変換の番号
+        :param inverse: 逆変換(変換後→元の盤面)を返すかどうか
+        """
+        assert self._symmetry
+        if inverse:
+            return self._sym_inverses[k]
+        return self._sym_perms[k]
+
+    def get_bitboard(self, color):
+        """
+        指定した色のビットボードを返す関数
+        ビット位置は y * (scale+1) + x
+        :param color: 石の色
+        """
+        return self._bits[color]
+
     def show_board(self):
         """
         碁盤を描画する
         """
+        print(self.to_string())
+
+    def to_string(self):
+        """
+        碁盤を描画した文字列を返す関数(ログに出力するとき用)
+        """
+        lines = []
         raw = ["|" for i in range(self._scale+1)]
         raw[self._scale] = " ====="
         underline = "-" + ("-" * (self._scale * 4))
-        print(underline)
+        lines.append(underline)
         for i in range(self._scale):
             for j in range(self._scale):
                 if self.get_val(j,i) == 0:
@@ -383,9 +988,358 @@ class Board(object):
                 if self.get_val(j,i) == 2:
                     raw[i] += " * "
                 raw[i] += "|"
-            print(raw[i])
-            print(underline)
-        print(raw[self._scale])
+            lines.append(raw[i])
+            lines.append(underline)
+        lines.append(raw[self._scale])
+        return "\n".join(lines)
+
+
+def _bit_lines(scale):
+    """
+    ビットボード用に，各セルを通る縦横斜め4方向の列のマスクとずらし幅を返す関数
+    各行の右端に番兵ビットを置くため，幅はscale+1とする
+    :return セルごとの[(マスク, ずらし幅), ...]のリスト
+    """
+    if scale in _BIT_LINES:
+        return _BIT_LINES[scale]
+    width = scale + 1
+    lines = []
+    for index in range(scale ** 2):
+        y, x = divmod(index, scale)
+        cell_lines = []
+        # 横，縦，右下がり，左下がりの順
+        for dx, dy in [(1, 0), (0, 1), (1, 1), (-1, 1)]:
+            mask = 0
+            for i in range(-scale, scale):
+                px = x + i * dx
+                py = y + i * dy
+                if 0 <= px < scale and 0 <= py < scale:
+                    mask |= 1 << (py * width + px)
+            cell_lines.append((mask, dy * width + dx))
+        lines.append(cell_lines)
+    _BIT_LINES[scale] = lines
+    return lines
+
+
+_BIT_LINES = {}
+
+
+def _symmetry_permutations(scale):
+    """
+    碁盤の8通りの対称変換(回転4通り×反転の有無)でのセルの対応を返す関数
+    :return (変換, 逆変換)の(8, scale*scale)の配列のタプル
+    """
+    if scale in _SYMMETRY_PERMUTATIONS:
+        return _SYMMETRY_PERMUTATIONS[scale]
+    index = np.arange(scale ** 2).reshape(scale, scale)
+    perms = np.zeros((8, scale ** 2), dtype=np.int64)
+    for k in range(8):
+        grid = np.rot90(index, k % 4)
+        if k >= 4:
+            grid = grid.T
+        # gridの位置jに元のセルgrid[j]が来るので，その逆を取る
+        perms[k, grid.ravel()] = np.arange(scale ** 2)
+    inverses = np.argsort(perms, axis=1)
+    _SYMMETRY_PERMUTATIONS[scale] = (perms, inverses)
+    return perms, inverses
+
+
+_SYMMETRY_PERMUTATIONS = {}
+
+
+def _five_windows(scale):
+    """
+    縦横斜めの全ての5マスの窓のインデックスを返す関数
+    :return (窓の数, 5)の配列
+    """
+    if scale in _FIVE_WINDOWS:
+        return _FIVE_WINDOWS[scale]
+    windows = []
+    for y in range(scale):
+        for x in range(scale):
+            for dx, dy in [(1, 0), (0, 1), (1, 1), (-1, 1)]:
+                end_x = x + 4 * dx
+                end_y = y + 4 * dy
+                if 0 <= end_x < scale and end_y < scale:
+                    windows.append([(y + i * dy) * scale + x + i * dx for i in range(5)])
+    windows = np.array(windows, dtype=np.int64).reshape(-1, 5)
+    _FIVE_WINDOWS[scale] = windows
+    return windows
+
+
+_FIVE_WINDOWS = {}
+
+# 窓の中の自分の石の数(相手の石がない場合)に対する重み
+_WINDOW_WEIGHTS = np.array([0, 1, 8, 64, 512, 100000, 100000], dtype=np.float64)
+
+
+def _window_counts(cells, color, windows):
+    """
+    各窓の中の自分と相手の石の数を返す関数
+    """
+    stones = cells[..., windows]
+    own = (stones == color).sum(axis=-1)
+    other = (stones == 3 - color).sum(axis=-1)
+    return own, other
+
+
+def _evaluate(cells, color, windows):
+    """
+    color側から見た盤面の評価値を返す関数
+    相手の石がない窓は自分の石の数に応じて加点し，自分の石がない窓は相手の石の数に応じて減点する
+    """
+    own, other = _window_counts(cells, color, windows)
+    return float(((other == 0) * _WINDOW_WEIGHTS[own]).sum() - ((own == 0) * _WINDOW_WEIGHTS[other]).sum())
+
+
+def _threat_scores(cells, color, windows):
+    """
+    空きセルごとに，そこに置いたときの脅威(攻め+守り)の大きさを返す関数
+    各窓について，自分の石を1つ増やしたときの重みの増分(攻め)と，
+    相手の石を1つ増やされたときの重みの増分(守り)を，窓に含まれるセルに足し合わせる
+    :param cells: 盤面((セル数,)の配列，または複数の盤面の(盤面数, セル数)の配列)
+    """
+    # 自分の石を1，相手の石を8として窓ごとに足し，石の数の組を1つの整数にしてから表を引く
+    keys = _STONE_CODES[color][cells][..., windows].sum(axis=-1)
+    gains = _THREAT_GAINS[keys]
+    if cells.ndim == 1:
+        scores = np.bincount(windows.ravel(), weights=np.repeat(gains, 5), minlength=cells.shape[0])
+    else:
+        # 複数の盤面は，窓とセルの対応行列を掛けてまとめて足し合わせる
+        scores = gains.dot(_window_incidence(windows, cells.shape[-1]))
+    scores[cells != 0] = float("-inf")
+    return scores
+
+
+def _threat_gains():
+    """
+    _threat_scoresで使う，窓の(自分の石の数 + 8 * 相手の石の数)に対する攻め+守りの点数の表を返す関数
+    """
+    own = np.arange(48) & 7
+    other = np.arange(48) >> 3
+    valid = (own <= 5) & (other <= 5)
+    own = np.minimum(own, 5)
+    other = np.minimum(other, 5)
+    attack = (other == 0) * (_WINDOW_WEIGHTS[own + 1] - _WINDOW_WEIGHTS[own])
+    defense = (own == 0) * (_WINDOW_WEIGHTS[other + 1] - _WINDOW_WEIGHTS[other]) * 0.8
+    return (attack + defense) * valid
+
+
+_THREAT_GAINS = _threat_gains()
+# 色ごとの，セルの値(0, 1, 2)から自分の石=1，相手の石=8への変換表
+_STONE_CODES = [None, np.array([0, 1, 8], dtype=np.int64), np.array([0, 8, 1], dtype=np.int64)]
+
+
+def _window_incidence(windows, nb_cells):
+    """
+    窓iがセルjを含むときに1となる(窓の数, セル数)の行列を返す関数
+    """
+    if nb_cells in _WINDOW_INCIDENCES:
+        return _WINDOW_INCIDENCES[nb_cells]
+    incidence = np.zeros((windows.shape[0], nb_cells), dtype=np.float64)
+    incidence[np.arange(windows.shape[0])[:, None], windows] = 1.0
+    _WINDOW_INCIDENCES[nb_cells] = incidence
+    return incidence
+
+
+_WINDOW_INCIDENCES = {}
+
+
+def _zobrist_table(scale):
+    """
+    Zobristハッシュ用の乱数表を返す関数
+    プロセスをまたいでも同じ値になるよう，サイズごとに固定のシードで生成する
+    :return table[セルのインデックス][色]の64bit整数(色0は0)
+    """
+    if scale in _ZOBRIST_TABLES:
+        return _ZOBRIST_TABLES[scale]
+    rng = np.random.RandomState(_ZOBRIST_SEED + scale)
+    values = rng.randint(1, 2 ** 64 - 1, size=(scale ** 2, 2), dtype=np.uint64)
+    table = [[0, int(v[0]), int(v[1])] for v in values]
+    _ZOBRIST_TABLES[scale] = table
+    return table
+
+
+_ZOBRIST_SEED = 20170707
+_ZOBRIST_TABLES = {}
+
+
+class BatchBoard(object):
+    """
+    複数の碁盤をまとめて保持し，一括で操作するクラス
+    N局分の碁盤を(N, scale*scale)の配列として持ち，石を置く・終了判定・初期化をまとめて行う
+    """
+
+    def __init__(self, n_games, scale, auto_reset=False):
+        """
+        一括碁盤オブジェクトのコンストラクタ
+        :param n_games: 同時に扱う対局数
+        :param scale: 碁盤のサイズ
+        :param auto_reset: put_and_judgeで決着した対局を自動で初期化するかどうか
+        """
+        self._n_games = n_games
+        self._scale = scale
+        self._auto_reset = auto_reset
+        # 盤外参照用に末尾に常に0の番兵列を持たせる
+        self._data = np.zeros((n_games, scale ** 2 + 1), dtype=np.int64)
+        self._cells = self._data[:, :scale ** 2]
+        self._turns = np.zeros(n_games, dtype=np.int64)
+        self._last_index = np.zeros(n_games, dtype=np.int64) - 1
+        self._last_color = np.zeros(n_games, dtype=np.int64)
+        self._rows = np.arange(n_games)
+        self._lines = _line_segments(scale)
+        # 9マスの線分から5マスを切り出すための窓
+        self._windows = np.arange(5)[None, :] + np.arange(5)[:, None]
+
+    def get_state(self):
+        """
+        全対局の碁盤の状態を返す関数
+        :return (N, scale*scale)の配列
+        """
+        return self._cells
+
+    def get_turn_count(self):
+        """
+        各対局の現在のターン数を返す関数
+        """
+        return self._turns
+
+    def get_legal_mask(self, rows=None):
+        """
+        石を置くことができるセルをTrueとしたマスクを返す関数
+        :param rows: 対象とする対局のインデックス（Noneなら全対局）
+        :return (対局数, scale*scale)のbool配列
+        """
+        if rows is None:
+            return self._cells == 0
+        return self._cells[rows] == 0
+
+    def get_valid_cells_index(self, row):
+        """
+        指定した対局で石を置くことができるセルのインデックスを返す
+        :param row: 対局のインデックス
+        """
+        return np.where(self._cells[row] == 0)[0]
+
+    def random_valid_index(self, rows=None):
+        """
+        各対局で置ける場所からランダムに1つ選んで返す関数
+        置ける場所がない対局には-1を返す
+        :param rows: 対象とする対局のインデックス（Noneなら全対局）
+        """
+        legal = self.get_legal_mask(rows)
+        keys = np.random.random(legal.shape)
+        keys[~legal] = -1.0
+        index = np.argmax(keys, axis=1)
+        index[~legal.any(axis=1)] = -1
+        return index
+
+    def index_to_point(self, index):
+        """
+        配列インデックスを座標に変換する関数（配列でも可）
+        """
+        return index % self._scale, index // self._scale
+
+    def point_to_index(self, x, y):
+        """
+        座標を配列のインデックスに変換する関数（配列でも可）
+        """
+        return y * self._scale + x
+
+    def put(self, index, color, rows=None):
+        """
+        指定した対局の指定インデックスに石を置く関数
+        :param index: 置く場所のインデックス（対局ごとの配列）
+        :param color: 石の色（スカラーまたは対局ごとの配列）
+        :param rows: 対象とする対局のインデックス（Noneなら全対局）
+        """
+        if rows is None:
+            rows = self._rows
+        index = np.asarray(index, dtype=np.int64)
+        color = np.broadcast_to(np.asarray(color, dtype=np.int64), index.shape)
+        assert np.all(self._cells[rows, index] == 0)
+        self._cells[rows, index] = color
+        self._turns[rows] += 1
+        self._last_index[rows] = index
+        self._last_color[rows] = color
+
+    def judge_game(self, rows=None):
+        """
+        各対局が終了したかどうかをまとめて返す関数
+        Board.judge_gameと同様に，最後に置いた石を含む列だけを調べる
+        :param rows: 対象とする対局のインデックス（Noneなら全対局）
+        :return 継続(0)，引き分け(3),勝った方の色を対局ごとに並べた配列
+        """
+        if rows is None:
+            rows = self._rows
+        rows = np.asarray(rows)
+        last = self._last_index[rows]
+        color = self._last_color[rows]
+        result = np.zeros(rows.shape[0], dtype=np.int64)
+        played = last >= 0
+        if not played.any():
+            return result
+        # 最後の石を中心とした4方向の9マスを取り出す(対局数, 4, 9)
+        lines = self._data[rows[:, None, None], self._lines[np.maximum(last, 0)]]
+        same = lines == color[:, None, None]
+        # 5マスの窓のどれかが全部同じ色なら勝ち
+        five = same[:, :, self._windows].all(axis=3).any(axis=(1, 2))
+        result[played & five] = color[played & five]
+        # 引き分け判定(元のjudge_gameと同様に置いた数で判定し，勝ちより優先)
+        result[self._turns[rows] >= self._scale ** 2] = 3
+        return result
+
+    def reset(self, rows=None):
+        """
+        指定した対局の碁盤を初期化する関数
+        :param rows: 対象とする対局のインデックス（Noneなら全対局）
+        """
+        if rows is None:
+            rows = self._rows
+        self._cells[rows] = 0
+        self._turns[rows] = 0
+        self._last_index[rows] = -1
+        self._last_color[rows] = 0
+
+    def put_and_judge(self, index, color, rows=None):
+        """
+        石を置いて終了判定まで行う関数
+        auto_resetが有効な場合，決着した対局はその場で初期化する
+        :return 対局ごとの判定結果の配列
+        """
+        if rows is None:
+            rows = self._rows
+        rows = np.asarray(rows)
+        self.put(index, color, rows)
+        result = self.judge_game(rows)
+        if self._auto_reset:
+            finished = rows[result != 0]
+            if finished.shape[0] > 0:
+                self.reset(finished)
+        return result
+
+
+def _line_segments(scale):
+    """
+    各セルを中心とした縦横斜め4方向の9マス分のインデックスを返す関数
+    盤外はscale*scale(番兵列)を指す
+    :return (scale*scale, 4, 9)の配列
+    """
+    if scale in _LINE_SEGMENTS:
+        return _LINE_SEGMENTS[scale]
+    offsets = np.arange(-4, 5)
+    y, x = np.divmod(np.arange(scale ** 2), scale)
+    segments = np.zeros((scale ** 2, 4, 9), dtype=np.int64)
+    for d, (dx, dy) in enumerate([(1, 0), (0, 1), (1, -1), (1, 1)]):
+        xs = x[:, None] + offsets[None, :] * dx
+        ys = y[:, None] + offsets[None, :] * dy
+        inside = (xs >= 0) & (xs < scale) & (ys >= 0) & (ys < scale)
+        segments[:, d, :] = np.where(inside, ys * scale + xs, scale ** 2)
+    _LINE_SEGMENTS[scale] = segments
+    return segments
+
+
+_LINE_SEGMENTS = {}
 
 
 class Game(object):
@@ -411,6 +1365,14 @@ class Game(object):
             assert self._first.get_board() == self._second.get_board()
             assert not self._first.get_board() is None
             self._board = self._first.get_board()
+        self._recorder = None
+
+    def set_recorder(self, recorder):
+        """
+        終局ごとに手順を書き込む記録器を設定する関数
+        :param recorder: records.GameRecordWriter(Noneなら記録しない)
+        """
+        self._recorder = recorder
 
     def play(self, display):
         """
@@ -420,6 +1382,7 @@ class Game(object):
         """
         result = 0
         actor = self._first
+        profile = PROFILER.enabled
         while result == 0:
             if display:
                 if actor == self._first:
@@ -430,27 +1393,44 @@ class Game(object):
             if display:
                 self._board.show_board()
             # 勝敗が決まるまでループ
+            if profile:
+                t = now()
             x, y,col = actor.action()
+            if profile:
+                t = PROFILER.lap("action", t)
             self._board.put(x, y, col)
+            if profile:
+                t = PROFILER.lap("put", t)
 
             if display:
                 print("%d 手目：%d , %d , %d" % (self._board.get_turn_count(), x, y, col))
 
             result = self._board.judge_game()
+            if profile:
+                PROFILER.lap("judge", t)
             if actor == self._first:
                 actor = self._second
             else:
                 actor = self._first
 
+        if profile:
+            PROFILER.count("games")
+        if self._recorder is not None:
+            self._recorder.write_board(self._board, result,
+                                       (type(self._first).__name__, type(self._second).__name__))
         return result
 
     def reset(self):
         """
         プレイヤーや碁盤の状態をリセットする関数
         """
+        if PROFILER.enabled:
+            t = now()
         self._first.reset()
         self._second.reset()
         self._board.reset()
+        if PROFILER.enabled:
+            PROFILER.lap("reset", t)
 
     def change(self):
         """
@@ -467,6 +1447,7 @@ class Game(object):
 
 
 if __name__ == "__main__":
+    import AI
     scale = 9
     board = Board(scale)
     player1 = HumanPlayer()
@@ -0,0 +1,112 @@
+# coding: utf-8
+import json
+import time
+import numpy as np
+
+# ヒストグラムの区間数(区間iはおよそ2^(i-1)〜2^iマイクロ秒)
+NB_BUCKETS = 32
+
+
+def now():
+    """
+    計測に使う現在時刻(秒)を返す関数
+    """
+    return time.perf_counter()
+
+
+class Profiler(object):
+    """
+    ゲームや学習の処理を段階(行動選択，石を置く，終了判定など)ごとに計測するクラス
+    呼び出し側は enabled がTrueのときだけ時刻を取って lap を呼ぶので，無効なときはほぼ負荷がない
+
+        if PROFILER.enabled:
+            t = now()
+        ...
+        if PROFILER.enabled:
+            t = PROFILER.lap("put", t)
+    """
+    def __init__(self):
+        self.enabled = False
+        self._totals = {}
+        self._histograms = {}
+        self._counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        """
+        集計した結果を消す関数
+        """
+        self._totals = {}
+        self._histograms = {}
+        self._counters = {}
+
+    def record(self, name, seconds):
+        """
+        段階nameに掛かった時間を記録する関数
+        """
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            histogram = np.zeros(NB_BUCKETS, dtype=np.int64)
+            self._histograms[name] = histogram
+            self._totals[name] = 0.0
+        self._totals[name] = self._totals[name] + seconds
+        histogram[min(int(seconds * 1e6).bit_length(), NB_BUCKETS - 1)] += 1
+
+    def lap(self, name, start):
+        """
+        startからの経過時間を段階nameとして記録し，現在時刻を返す関数
+        戻り値を次の段階のstartに使える
+        """
+        t = now()
+        self.record(name, t - start)
+        return t
+
+    def count(self, name, n=1):
+        """
+        カウンタnameをn増やす関数
+        """
+        self._counters[name] = self._counters.get(name, 0) + n
+
+    def report(self):
+        """
+        これまでの集計結果を返す関数
+        :return 段階ごとの{回数, 合計秒数, 平均秒数, ヒストグラム}と，カウンタのdict
+        """
+        phases = {}
+        for name, histogram in self._histograms.items():
+            count = int(histogram.sum())
+            phases[name] = {
+                "count": count,
+                "total": self._totals[name],
+                "mean": self._totals[name] / count,
+                # キーは区間の上限(マイクロ秒)
+                "histogram_us": dict((str(2 ** i), int(c)) for i, c in enumerate(histogram) if c > 0),
+            }
+        return {"phases": phases, "counters": dict(self._counters)}
+
+    def dump(self, path):
+        """
+        集計結果をJSONで保存する関数
+        """
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+    def show(self):
+        """
+        集計結果を合計時間の長い順に表示する関数
+        """
+        phases = self.report()["phases"]
+        for name in sorted(phases, key=lambda n: -phases[n]["total"]):
+            p = phases[name]
+            print("%-20s %10d回 %10.3f秒 平均%8.2fus" % (name, p["count"], p["total"], p["mean"] * 1e6))
+        for name, value in sorted(self._counters.items()):
+            print("%-20s %10d" % (name, value))
+
+
+# 全体で共有するプロファイラ
+PROFILER = Profiler()
@@ -0,0 +1,104 @@
+# coding: utf-8
+import json
+import logging
+import queue
+import threading
+import time
+
+# ライブラリ全体のロガーの名前の接頭辞
+LOGGER_NAME = "gomoku"
+
+
+def get_logger(name):
+    """
+    モジュールごとのロガーを返す関数
+    setup_loggingを呼ばない限りWARNING未満は出力しないので，大量に対戦・学習するときは静か
+    """
+    return logging.getLogger(LOGGER_NAME + "." + name)
+
+
+def setup_logging(level=logging.INFO, path=None):
+    """
+    ログの出力先とレベルを設定する関数(デバッグ時に使う)
+    :param level: 出力するレベル(盤面まで見たい場合はlogging.DEBUG)
+    :param path: 出力するファイル(Noneなら標準エラー出力)
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    handler = logging.FileHandler(path) if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return logger
+
+
+class Sampler(object):
+    """
+    N回に1回だけTrueを返すクラス(盤面を間引いて出力するときに使う)
+    """
+    def __init__(self, every):
+        """
+        :param every: 何回に1回Trueを返すか(0以下なら常にFalse)
+        """
+        self._every = every
+        self._count = 0
+
+    def hit(self):
+        if self._every <= 0:
+            return False
+        self._count = self._count + 1
+        if self._count >= self._every:
+            self._count = 0
+            return True
+        return False
+
+
+class EpisodeSink(object):
+    """
+    対戦や学習の1エピソードごとの記録を，JSON Lines形式でファイルに書き出すクラス
+    writeはキューに入れるだけで，書き出しは別スレッドがまとめて行う
+    """
+    def __init__(self, path, batch_size=1000, flush_interval=1.0):
+        """
+        :param path: 出力するファイル(追記する)
+        :param batch_size: まとめて書き出す記録の数
+        :param flush_interval: 記録が溜まらなくても書き出す間隔(秒)
+        """
+        self._file = open(path, "a")
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, record):
+        """
+        記録(dict)を1つ書き出す関数
+        """
+        self._queue.put(record)
+
+    def _run(self):
+        closing = False
+        while not closing:
+            lines = []
+            deadline = time.time() + self._flush_interval
+            while len(lines) < self._batch_size:
+                try:
+                    record = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if record is None:
+                    closing = True
+                    break
+                lines.append(json.dumps(record))
+            if lines:
+                self._file.write("\n".join(lines) + "\n")
+                self._file.flush()
+
+    def close(self):
+        """
+        残っている記録を書き出してファイルを閉じる関数
+        """
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
@@ -0,0 +1,223 @@
+# coding: utf-8
+import collections
+import mmap
+import os
+import struct
+import numpy as np
+
+# ファイルの先頭に置く識別子(最後の1バイトは版)
+MAGIC = b"GMKR\x01"
+# 1局の先頭: サイズ, 結果, 手数, 先手の名前の長さ, 後手の名前の長さ
+_HEADER = struct.Struct("<BBHBB")
+
+# 1局の記録
+# moves は置いたセルのインデックスの配列(先手(色1)から交互に置く)
+GameRecord = collections.namedtuple("GameRecord", ["scale", "result", "players", "moves"])
+
+
+def _move_dtype(scale):
+    """
+    1手を表す型を返す関数
+    セル数が256以下なら1バイト，それより大きい碁盤(19路など)では2バイト
+    """
+    if scale ** 2 <= 256:
+        return np.dtype(np.uint8)
+    return np.dtype("<u2")
+
+
+class GameRecordWriter(object):
+    """
+    対局の記録をバイナリ形式でファイルに追記するクラス
+    記録はメモリ上に溜めておき，buffer_sizeを超えたらまとめて書き出す
+    形式: MAGIC，続いて1局ごとに _HEADER，先手と後手の名前(UTF-8)，1手1(または2)バイトの手
+    """
+    def __init__(self, path, buffer_size=1 << 20):
+        """
+        :param path: 出力するファイル(既にあれば追記する)
+        :param buffer_size: まとめて書き出すバイト数
+        """
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            with open(path, "rb") as f:
+                assert f.read(len(MAGIC)) == MAGIC
+        self._file = open(path, "ab")
+        if not exists:
+            self._file.write(MAGIC)
+        self._buffer_size = buffer_size
+        self._buffer = bytearray()
+        self._count = 0
+
+    def write(self, scale, result, moves, players=("", "")):
+        """
+        1局分の記録を書き込む関数
+        :param scale: 碁盤のサイズ
+        :param result: 試合の結果(judge_gameの値)
+        :param moves: 置いたセルのインデックスの列(先手から交互)
+        :param players: (先手の名前, 後手の名前)
+        """
+        names = [p.encode("utf-8") for p in players]
+        assert len(names) == 2 and len(names[0]) < 256 and len(names[1]) < 256
+        moves = np.asarray(moves, dtype=_move_dtype(scale))
+        self._buffer += _HEADER.pack(scale, result, moves.shape[0], len(names[0]), len(names[1]))
+        self._buffer += names[0] + names[1]
+        self._buffer += moves.tobytes()
+        self._count = self._count + 1
+        if len(self._buffer) >= self._buffer_size:
+            self.flush()
+
+    def write_board(self, board, result, players=("", "")):
+        """
+        終局した碁盤の手順を1局分の記録として書き込む関数
+        :param board: 碁盤(resetする前に呼ぶ)
+        """
+        scale = board._scale
+        for i, (x, y, color) in enumerate(board._history):
+            assert color == i % 2 + 1
+        self.write(scale, result, [y * scale + x for x, y, color in board._history], players)
+
+    def get_count(self):
+        """
+        書き込んだ対局数を返す関数
+        """
+        return self._count
+
+    def flush(self):
+        """
+        溜めている記録をファイルに書き出す関数
+        """
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+        self._file.flush()
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+
+def _parse(data, offset):
+    """
+    offsetから始まる1局を読む関数
+    :return (記録, 次の局の位置)のタプル
+    """
+    scale, result, n_moves, len_first, len_second = _HEADER.unpack_from(data, offset)
+    offset = offset + _HEADER.size
+    first = bytes(data[offset:offset + len_first]).decode("utf-8")
+    offset = offset + len_first
+    second = bytes(data[offset:offset + len_second]).decode("utf-8")
+    offset = offset + len_second
+    dtype = _move_dtype(scale)
+    moves = np.frombuffer(data, dtype=dtype, count=n_moves, offset=offset).astype(np.int64)
+    return GameRecord(scale, result, (first, second), moves), offset + n_moves * dtype.itemsize
+
+
+def _skip(data, offset):
+    """
+    offsetから始まる1局を読み飛ばして，次の局の位置を返す関数
+    """
+    scale, result, n_moves, len_first, len_second = _HEADER.unpack_from(data, offset)
+    return offset + _HEADER.size + len_first + len_second + n_moves * _move_dtype(scale).itemsize
+
+
+def _open_mmap(path):
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    assert data[:len(MAGIC)] == MAGIC
+    return data
+
+
+def read_games(path):
+    """
+    ファイルの記録を先頭から1局ずつ返すジェネレータ
+    ファイルはメモリマップで読むので，大きなファイルでも全体を読み込まない
+    """
+    data = _open_mmap(path)
+    try:
+        offset = len(MAGIC)
+        while offset < len(data):
+            record, offset = _parse(data, offset)
+            yield record
+    finally:
+        data.close()
+
+
+class GameRecordReader(object):
+    """
+    記録のファイルのN局目を直接読むためのクラス
+    各局の位置の索引を path + ".idx" に保存しておき，ファイルに追記された分だけ索引を伸ばす
+    reader[n] でn局目，len(reader)で局数を返す
+    """
+    def __init__(self, path):
+        self._path = path
+        self._data = _open_mmap(path)
+        self._offsets = self._build_index()
+
+    def _index_path(self):
+        return self._path + ".idx"
+
+    def _build_index(self):
+        """
+        索引を読み込み，索引の後に追記された局の位置を加えて返す関数
+        索引は各局の開始位置と，最後の局の終わりの位置(int64)
+        """
+        offsets = [len(MAGIC)]
+        if os.path.exists(self._index_path()):
+            saved = np.fromfile(self._index_path(), dtype=np.int64)
+            if saved.shape[0] > 0 and saved[-1] <= len(self._data):
+                offsets = saved.tolist()
+        n_saved = len(offsets)
+        offset = offsets[-1]
+        while offset < len(self._data):
+            offset = _skip(self._data, offset)
+            offsets.append(offset)
+        offsets = np.array(offsets, dtype=np.int64)
+        if offsets.shape[0] != n_saved:
+            tmp = self._index_path() + ".tmp"
+            offsets.tofile(tmp)
+            os.replace(tmp, self._index_path())
+        return offsets
+
+    def __len__(self):
+        return self._offsets.shape[0] - 1
+
+    def __getitem__(self, n):
+        if n < 0:
+            n = n + len(self)
+        if not 0 <= n < len(self):
+            raise IndexError(n)
+        return _parse(self._data, int(self._offsets[n]))[0]
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def close(self):
+        self._data.close()
+
+
+def replay(record, board):
+    """
+    記録の手順を碁盤に並べる関数
+    :param board: recordと同じサイズの碁盤(初期化してから並べる)
+    """
+    board.reset()
+    for i, index in enumerate(record.moves):
+        x, y = board.index_to_point(int(index))
+        board.put(x, y, i % 2 + 1)
+    return board
+
+
+if __name__ == "__main__":
+    import gomoku
+    board = gomoku.Board(9)
+    game = gomoku.Game(gomoku.RandomPlayer(), gomoku.HeuristicPlayer(), board)
+    writer = GameRecordWriter("games.rec")
+    game.set_recorder(writer)
+    for i in range(1000):
+        game.reset()
+        game.play(False)
+        game.change()
+    writer.close()
+    reader = GameRecordReader("games.rec")
+    print(len(reader), reader[-1])
+    reader.close()
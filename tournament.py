@@ -0,0 +1,208 @@
+# coding: utf-8
+import functools
+import glob
+import itertools
+import math
+import multiprocessing
+import os
+import sqlite3
+from datetime import datetime
+import numpy as np
+import AI
+import gomoku
+from metrics import get_logger
+
+logger = get_logger("tournament")
+
+# 重みファイルの代わりに指定できる組み込みのプレイヤー
+BUILTIN_PLAYERS = {
+    "random": lambda: gomoku.RandomPlayer(),
+    "fool": lambda: gomoku.FoolAI(),
+    "heuristic": lambda: gomoku.HeuristicPlayer(),
+    "mcts": lambda: gomoku.MCTSPlayer(playouts=200, rollout="local"),
+    "search": lambda: gomoku.SearchPlayer(time_limit=0.1, max_depth=2),
+}
+
+# Eloレーティングの平均
+ELO_MEAN = 1500.0
+
+
+def make_player(spec, scale=9):
+    """
+    プレイヤーの指定からプレイヤーを生成する関数
+    :param spec: BUILTIN_PLAYERSの名前，またはDQNの重みファイルのパス
+    :param scale: 碁盤のサイズ(重みファイルはこのサイズで学習したものを指定する)
+    """
+    if spec in BUILTIN_PLAYERS:
+        return BUILTIN_PLAYERS[spec]()
+    # Kerasを読み込むのは重みファイルを使うワーカーだけ(AI自体はKerasを読み込まない)
+    return AI.dqn_player(spec, scale)
+
+
+def find_checkpoints(directory=".", pattern="[0-9]" * 14):
+    """
+    learningが保存した日時の名前の重みファイルを古い順に返す関数
+    """
+    return sorted(glob.glob(os.path.join(directory, pattern)))
+
+
+class Tournament(object):
+    """
+    重みファイル(チェックポイント)と組み込みのプレイヤーで総当たり戦を行うクラス
+    対戦結果はSQLiteに保存し，同じ条件(サイズ，試合数，シード)で対戦済みの組はやり直さない
+    そのため新しいチェックポイントを1つ加えたときは，そのプレイヤーの対戦だけを行う
+    """
+    def __init__(self, db_path, players, scale=9, games=20, seed=0):
+        """
+        :param db_path: 結果を保存するSQLiteのファイル
+        :param players: プレイヤーの指定のリスト(make_playerを参照)
+        :param scale: 碁盤のサイズ
+        :param games: 1つの組の試合数(先手・後手を1試合ごとに入れ替える)
+        :param seed: 乱数のシード
+        """
+        assert len(set(players)) == len(players)
+        self._players = list(players)
+        self._scale = scale
+        self._games = games
+        self._seed = seed
+        self._db = sqlite3.connect(db_path)
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "player_a TEXT NOT NULL, player_b TEXT NOT NULL, "
+                         "scale INTEGER NOT NULL, games INTEGER NOT NULL, seed INTEGER NOT NULL, "
+                         "wins_a INTEGER NOT NULL, wins_b INTEGER NOT NULL, draws INTEGER NOT NULL, "
+                         "date TEXT NOT NULL, "
+                         "PRIMARY KEY (player_a, player_b, scale, games, seed))")
+        self._db.commit()
+
+    def get_players(self):
+        return list(self._players)
+
+    def pairings(self):
+        """
+        まだ結果がない組のリストを返す関数
+        組の2人は名前の順に並べる
+        """
+        done = set((r[0], r[1]) for r in self._select())
+        pairs = [tuple(sorted(p)) for p in itertools.combinations(self._players, 2)]
+        return [p for p in pairs if p not in done]
+
+    def _select(self):
+        return self._db.execute("SELECT player_a, player_b, wins_a, wins_b, draws FROM results "
+                                "WHERE scale = ? AND games = ? AND seed = ?",
+                                (self._scale, self._games, self._seed)).fetchall()
+
+    def run(self, processes=None):
+        """
+        結果がない組の対戦をプロセスプールで並列に行い，終わった組から保存する関数
+        途中で止めても，保存済みの組は次の実行でやり直さない
+        :param processes: ワーカー数(Noneなら CPU数)
+        :return 対戦した組の数
+        """
+        pairs = self.pairings()
+        if not pairs:
+            return 0
+        if processes is None:
+            processes = os.cpu_count()
+        tasks = [(a, b, self._scale, self._games, self._seed) for a, b in pairs]
+        # 重みファイルのプレイヤーはKeras(TensorFlow)を使うので，forkではなくspawnで起動する
+        pool = multiprocessing.get_context("spawn").Pool(min(processes, len(tasks)))
+        try:
+            for a, b, wins_a, wins_b, draws in pool.imap_unordered(_play_pairing_task, tasks):
+                self._db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (a, b, self._scale, self._games, self._seed, wins_a, wins_b, draws,
+                                  datetime.now().isoformat()))
+                self._db.commit()
+                logger.info("%s vs %s: %d-%d-%d", a, b, wins_a, wins_b, draws)
+        finally:
+            pool.close()
+            pool.join()
+        return len(pairs)
+
+    def results(self):
+        """
+        参加しているプレイヤー同士の対戦結果を返す関数
+        :return (プレイヤーA, プレイヤーB, Aの勝数, Bの勝数, 引き分け数)のリスト
+        """
+        players = set(self._players)
+        return [r for r in self._select() if r[0] in players and r[1] in players]
+
+    def ratings(self):
+        """
+        対戦結果から求めたEloレーティングをdictで返す関数
+        """
+        return elo_ratings(self._players, self.results())
+
+    def show(self):
+        """
+        レーティングの高い順に表示する関数
+        """
+        ratings = self.ratings()
+        for spec in sorted(ratings, key=lambda s: -ratings[s]):
+            print("%8.1f %s" % (ratings[spec], spec))
+
+    def close(self):
+        self._db.close()
+
+
+def elo_ratings(players, results, prior=1.0, iterations=1000):
+    """
+    全ての対戦結果に最もよく合うEloレーティングを求める関数
+    (対戦の順番によらないよう，逐次更新ではなくまとめて最尤推定する)
+    全勝・全敗のプレイヤーが発散しないよう，対戦した組ごとにprior試合分の引き分けを加える
+    :param players: プレイヤーのリスト
+    :param results: (プレイヤーA, プレイヤーB, Aの勝数, Bの勝数, 引き分け数)のリスト
+    :return プレイヤー→レーティングのdict(平均はELO_MEAN)
+    """
+    index = dict((p, i) for i, p in enumerate(players))
+    n = len(players)
+    # score[i, j]: iがjから得た点(勝ち1，引き分け0.5)，count[i, j]: iとjの試合数
+    score = np.zeros((n, n))
+    count = np.zeros((n, n))
+    for a, b, wins_a, wins_b, draws in results:
+        i = index[a]
+        j = index[b]
+        games = wins_a + wins_b + draws + prior
+        score[i, j] += wins_a + 0.5 * (draws + prior)
+        score[j, i] += wins_b + 0.5 * (draws + prior)
+        count[i, j] += games
+        count[j, i] += games
+    total = count.sum(axis=1)
+    ratings = np.zeros(n)
+    played = total > 0
+    scale = 400.0 / math.log(10.0)
+    for _ in range(iterations):
+        expected = 1.0 / (1.0 + 10.0 ** ((ratings[None, :] - ratings[:, None]) / 400.0))
+        # 対数尤度の勾配を，各プレイヤーの試合数で割って1ステップ進める
+        gradient = (score - count * expected).sum(axis=1)
+        step = np.zeros(n)
+        step[played] = 4.0 * scale * gradient[played] / total[played]
+        ratings = ratings + step
+        if np.abs(step).max() < 1e-6:
+            break
+    ratings = ratings - ratings[played].mean() + ELO_MEAN if played.any() else ratings + ELO_MEAN
+    return dict((p, float(ratings[index[p]])) for p in players)
+
+
+def _play_pairing_task(task):
+    return _play_pairing(*task)
+
+
+def _play_pairing(a, b, scale, games, seed):
+    """
+    1つの組の対戦を行うワーカー関数
+    AI.simulate_parallelと同じく，1試合ごとに先手/後手を入れ替え，(seed, 試合番号)から決まる乱数で対戦する
+    :return (プレイヤーA, プレイヤーB, Aの勝数, Bの勝数, 引き分け数)
+    """
+    first_win, second_win, _, draws = AI._simulate_range(
+        0, games, functools.partial(make_player, a, scale), functools.partial(make_player, b, scale),
+        True, seed, scale)
+    wins_a = first_win + second_win
+    return a, b, wins_a, games - wins_a - draws, draws
+
+
+if __name__ == "__main__":
+    players = ["random", "fool", "heuristic"] + find_checkpoints(".")
+    tournament = Tournament("tournament.sqlite", players, scale=9, games=20)
+    tournament.run()
+    tournament.show()
+    tournament.close()